@@ -15,19 +15,30 @@ Mercurial configuration files
 setting a username.
 '''
 from __future__ import with_statement
-from iniparse import SafeConfigParser
+from iniparse import RawConfigParser, SafeConfigParser, SectionIndex, \
+                     ParseCache, LayeredConfig
+from iniparse.index import read_section, splice_section
+from discovery import findrepo, findrepos
 from mercurial.i18n import _
 from mercurial import commands, hg, util, error
-from ConfigParser import NoOptionError, NoSectionError
+from ConfigParser import NoSectionError, Error as ConfigError
 import os
 import sys
 import re
+import threading
+import Queue
+import tempfile
+import stat
+import time
+from hashlib import sha1
 
 
 def hgrccli(ui, **opts):
     """
-    Edit mercurial configuration files. Takes a string to add or remove
-    from a configuration and a set of targets.
+    Edit mercurial configuration files. Takes strings to add or remove
+    from a configuration and a set of targets. '-a' and '-d' may be
+    given any number of times; each target file is read and written
+    once for all of them.
     Usually the user default file will be targeted, this is
     done with the '-u' flag.
 
@@ -52,10 +63,57 @@ def hgrccli(ui, **opts):
     (Removes the entire [extensions] section from your current repository's
      config and the configuation located at ~/foo/bar.rc)
 
+    hg cedit -a "ui.verbose = True" -a "ui.merge = meld" -d "ui.editor" -u
+    (Makes all three changes to your default user configuration file,
+     adding before deleting)
+
+    hg cedit -o changes.txt -u
+    (Applies the operations in changes.txt, one per line in the form
+     'add <section>.<prop> = <value>' or 'delete <section>[.<prop>]',
+     after any given with '-a' or '-d'. Use '-o -' to read them from
+     standard input.)
+
+    hg cedit -a "ui.merge = meld" --fleet /srv/clones --jobs 16
+    (Sets ui.merge in the .hg/hgrc of every repository found under
+     /srv/clones, on 16 processes at once, and reports on each repository
+     and the time taken. --fleet may also name repositories, and may be
+     given several times. The working directories of the repositories
+     found are not searched for more, unless --nested is given. It can't
+     be combined with -u, -g, -l, -f or -e.)
+
+    hg cedit -w "ui.username"
+    (Shows the value of ui.username that Mercurial uses, and the file and
+     line that set it. Files are read as Mercurial reads them, following
+     %include and %unset. Give a section name to show the whole section.)
+
+    Parsed files can be cached between runs by setting cedit.cache to a
+    directory, and optionally cedit.cachesize to its size limit in KB.
+
     For more information on configuration files,
     see http://www.selenic.com/mercurial/hgrc.5.html or 'man 5 hgrc'.
     """
-    if len(sys.argv) > 2:
+    if opts['where']:
+        showorigin(ui, LayeredConfig(layerpaths()), opts['where'])
+    elif opts['fleet']:
+        given = [flag for flag, name in (('-u', 'user'), ('-g', 'global'),
+                                         ('-l', 'local'), ('-f', 'file'),
+                                         ('-e', 'env'))
+                 if opts[name]]
+        if given:
+            ui.warn(_("--fleet can't be combined with %s "
+                      "(nothing written).\n") % ", ".join(given))
+            return 1
+        ops = cliops(ui, opts)
+        if ops:
+            roots = []
+            for root in opts['fleet']:
+                if os.path.isdir(os.path.expanduser(root)):
+                    roots.append(root)
+                else:
+                    ui.warn(_("No directory '%s', skipping.\n") % root)
+            return runfleet(ui, findrepos(roots, opts['nested']), ops,
+                            opts['jobs'])
+    elif len(sys.argv) > 2:
         paths = []
         if opts['user']:
             paths.append(defaultpath("user", ui))
@@ -74,14 +132,23 @@ def hgrccli(ui, **opts):
         if not paths:
             ui.warn(_('No configuration selected (nothing written).\n'))
             sys.exit(0)
-        if opts['add']:
-            setoption(ui, paths, opts['add'])
-        if opts['delete']:
-            deleteoption(ui, paths, opts['delete'])
+        ops = cliops(ui, opts)
+        if ops:
+            return runops(ui, paths, ops)
     else:
         hgconfig(ui)
 
 
+def cliops(ui, opts):
+    """Returns the operations given by the -a, -d and -o options"""
+    ops = [parseop(ui, 'add', optstring) for optstring in opts['add']]
+    ops.extend([parseop(ui, 'delete', delstring)
+                for delstring in opts['delete']])
+    if opts['operations']:
+        ops.extend(readops(ui, opts['operations']))
+    return [op for op in ops if op]
+
+
 def setuser(ui, **opts):
     """
     Sets ui.username field in Mercurial configuration.
@@ -113,8 +180,7 @@ def setuser(ui, **opts):
     if not os.path.exists(path):
         with open(path, "wb") as _empty:
             pass # create empty file
-    conf = SafeConfigParser()
-    conf.read(path)
+    conf, save = loadconf(ui, path, 'ui')
     if opts['username']:
         username = opts['username']
     else:
@@ -131,7 +197,7 @@ def setuser(ui, **opts):
     if 'ui' not in conf.sections():
         conf.add_section('ui')
     conf.set('ui', 'username', username)
-    savepretty(conf, path)
+    save()
     ui.status(_("Username saved in %s\n") % path)
 
 
@@ -140,21 +206,9 @@ def setoption(ui, paths, optstring):
     Sets option given in optstring in every path given in paths.
     Creates files, sections, and properties as needed.
     """
-    match = re.search("^([\w\-<>]+)\.([\w\-<>\.]+)\s*=\s*(.*)", optstring)
-    if not match:
-        ui.warn(_("Invalid add property syntax. See 'hg help cedit'.\n"))
-    else:
-        sec = match.group(1)
-        prop = match.group(2)
-        val = match.group(3)
-        for path in paths:
-            conf = SafeConfigParser()
-            conf.read(path)
-            if sec not in conf.sections():
-                conf.add_section(sec)
-            conf.set(sec, prop, val)
-            savepretty(conf, path)
-            ui.status(_("Property set in %s\n") % path)
+    op = parseop(ui, 'add', optstring)
+    if op:
+        return runops(ui, paths, [op])
 
 
 def deleteoption(ui, paths, delstring):
@@ -164,63 +218,437 @@ def deleteoption(ui, paths, delstring):
     To delete a property, the delstring should be the property qualified
     with the section, e.g. ui.username
     """
-    secmatch = re.search("^\s*([\w\-<>]+)\s*$", delstring)
-    propmatch = re.search("^\s*([\w\-<>]+)\.([\w\-<>\.]+)\s*$", delstring)
+    op = parseop(ui, 'delete', delstring)
+    if op:
+        return runops(ui, paths, [op])
+
+
+def parseop(ui, kind, opstring):
+    """
+    Returns the operation for an add or delete string, as taken by
+    applyop, or None if the string is invalid.
+    """
+    if kind == 'add':
+        match = re.search("^([\w\-<>]+)\.([\w\-<>\.]+)\s*=\s*(.*)", opstring)
+        if not match:
+            ui.warn(_("Invalid add property syntax. See 'hg help cedit'.\n"))
+            return None
+        return ('set', match.group(1), match.group(2), match.group(3))
+    secmatch = re.search("^\s*([\w\-<>]+)\s*$", opstring)
+    propmatch = re.search("^\s*([\w\-<>]+)\.([\w\-<>\.]+)\s*$", opstring)
+    if secmatch:
+        return ('remove_section', secmatch.group(1))
+    elif propmatch:
+        return ('remove_option', propmatch.group(1), propmatch.group(2))
+    ui.warn(_("Invalid delete syntax. See 'hg help cedit'.\n"))
+    return None
+
+
+def readops(ui, source):
+    """
+    Returns the operations in the file source ('-' for stdin). Each line
+    is 'add <section>.<property> = <value>' or 'delete <section>' or
+    'delete <section>.<property>'; blank lines and '#' comments are
+    skipped.
+    """
+    if source == '-':
+        lines = sys.stdin.readlines()
+    else:
+        with open(os.path.expanduser(source)) as f:
+            lines = f.readlines()
+    ops = []
+    for lineno, line in enumerate(lines):
+        line = line.strip()
+        if not line or line.startswith('#'):
+            continue
+        parts = line.split(None, 1)
+        if parts[0] in ('add', 'delete') and len(parts) == 2:
+            op = parseop(ui, parts[0], parts[1])
+            if op:
+                ops.append(op)
+        else:
+            ui.warn(_("Invalid operation at %s:%d: %s\n") %
+                    (source, lineno + 1, line))
+    return ops
+
+
+def runops(ui, paths, ops):
+    """
+    Applies every operation in ops to every path in paths, reading and
+    writing each file only once. Returns 1 if any of the files could not
+    be loaded, and 0 otherwise.
+    """
+    sections = set([op[1] for op in ops])
+    if len(sections) == 1:
+        sec = sections.pop()
+    else:
+        sec = None # the whole file is needed
+    loaded = 0
+    for path, conf, save in loadconfs(ui, paths, sec):
+        loaded += 1
+        changed = False
+        for op in ops:
+            if applyop(ui, conf, path, op):
+                changed = True
+        if changed:
+            save()
+    return int(loaded < len(paths))
+
+
+def applyop(ui, conf, path, op):
+    """
+    Applies the operation op to conf, the configuration at path.
+    Returns whether conf was changed.
+    """
+    sec = op[1]
+    if op[0] == 'set':
+        if sec not in conf.sections():
+            conf.add_section(sec)
+        conf.set(sec, op[2], op[3])
+        ui.status(_("Property set in %s\n") % path)
+        return True
+    if sec not in conf.sections():
+        ui.status(_("Success: No section '%s' in %s, "+
+        "so it's already gone.\n") % (sec, path))
+    elif op[0] == 'remove_section':
+        conf.remove_section(sec)
+        ui.status(_("Section removed from %s\n") % path)
+        return True
+    elif conf.lookup(sec, op[2], raw=True) is None:
+        ui.status(_("Success: No property '%s' in %s, "+
+        "so it's already gone.\n") % (op[2], path))
+    elif conf.remove_option(sec, op[2]):
+        ui.status(_("%s.%s removed from %s\n") % (sec, op[2], path))
+        return True
+    else:
+        ui.warn(_("Unable to remove %s.%s from %s\n") % (sec, op[2], path))
+    return False
+
+class bufferui(object):
+    """
+    Stands in for ui where messages have to be collected rather than
+    shown, as in the worker processes of runfleet
+    """
+    def __init__(self):
+        self.messages = []
+        self.warnings = []
+
+    def status(self, msg):
+        self.messages.append(msg)
+
+    def warn(self, msg):
+        self.warnings.append(msg)
+
+    def config(self, section, name, default=None):
+        return default
+
+
+def fleetrepo(args):
+    """
+    Applies ops to the configuration of the repository repo. Returns
+    (repo, messages, warnings, seconds taken).
+    """
+    repo, ops = args
+    start = time.time()
+    ui = bufferui()
+    path = os.path.join(repo, '.hg', 'hgrc')
+    try:
+        if not os.path.exists(path):
+            open(path, 'ab').close()
+        runops(ui, [path], ops)
+    except Exception, inst:
+        ui.warn("%s\n" % inst)
+    return repo, ui.messages, ui.warnings, time.time() - start
+
+
+def runfleet(ui, repos, ops, jobs=0):
+    """
+    Applies ops to every repository in repos on a pool of jobs worker
+    processes (by default one per CPU), or one after another if a pool
+    can't be used. Reports on each repository and on the total time.
+    Returns 1 if there were problems with any repository, and 0 otherwise.
+    """
+    start = time.time()
+    work = [(repo, ops) for repo in repos]
+    pool = None
+    if len(work) > 1 and jobs != 1:
+        try:
+            import multiprocessing
+            pool = multiprocessing.Pool(jobs or None)
+        except (ImportError, OSError, NotImplementedError):
+            pass
+    if pool is None:
+        results = map(fleetrepo, work)
+    else:
+        try:
+            results = pool.map(fleetrepo, work, 16)
+        finally:
+            pool.close()
+            pool.join()
+    busy = 0.0
+    failed = 0
+    for repo, messages, warnings, seconds in results:
+        busy += seconds
+        if warnings:
+            failed += 1
+            ui.warn(_("%s: %d problem(s) (%.3fs)\n") %
+                    (repo, len(warnings), seconds))
+        else:
+            ui.status(_("%s: ok (%.3fs)\n") % (repo, seconds))
+        for msg in messages:
+            ui.note("  %s" % msg)
+        for msg in warnings:
+            ui.warn("  %s" % msg)
+    elapsed = time.time() - start
+    ui.status(_("%d repositories, %d with problems, in %.2fs "
+                "(%.2fs of work, %.1fms per repository)\n") %
+              (len(results), failed, elapsed, busy,
+               results and 1000 * elapsed / len(results) or 0))
+    return int(failed > 0)
+
+
+def showorigin(ui, layers, wherestring):
+    """
+    Shows the effective value of the property or every property of the
+    section in wherestring, with the file and line that set it.
+    """
+    secmatch = re.search("^\s*([\w\-<>]+)\s*$", wherestring)
+    propmatch = re.search("^\s*([\w\-<>]+)\.([\w\-<>\.]+)\s*$", wherestring)
     if secmatch:
         sec = secmatch.group(1)
-        for path in paths:
-            conf = SafeConfigParser()
-            conf.read(path)
-            if sec not in conf.sections():
-                ui.status(_("Success: No section '%s' in %s,"+
-                " so it's already gone.\n") % (sec, path))
-            else:
-                conf.remove_section(sec)
-                savepretty(conf, path)
-                ui.status(_("Section removed from %s\n") % path)
+        props = [prop for prop, val in layers.items(sec)]
+        if not props:
+            ui.status(_("No section '%s' in any configuration\n") % sec)
     elif propmatch:
         sec = propmatch.group(1)
-        prop = propmatch.group(2)
-        for path in paths:
-            conf = SafeConfigParser()
-            conf.read(path)
-            if sec not in conf.sections():
-                ui.status(_("Success: No section '%s' in %s, "+
-                "so it's already gone.\n") % (sec, path))
-            elif not conf.has_option(sec, prop):
-                ui.status(_("Success: No property '%s' in %s, "+
-                "so it's already gone.\n") % (prop, path))
-            else:
-                removed = conf.remove_option(sec, prop)
-                if removed:
-                    savepretty(conf, path)
-                    ui.status(_("%s removed from %s\n") % (delstring, path))
-                else:
-                    ui.warn(_("Unable to remove %s from %s\n") %
-                    (delstring, path))
+        props = [propmatch.group(2)]
     else:
-        ui.warn(_("Invalid delete syntax. See 'hg help cedit'.\n"))
+        ui.warn(_("Invalid syntax. See 'hg help cedit'.\n"))
+        return
+    for prop in props:
+        origin = layers.origin(sec, prop)
+        if origin is None:
+            ui.status(_("%s.%s is not set\n") % (sec, prop))
+        else:
+            ui.status(_("%s.%s = %s\n  (set in %s, line %d)\n") %
+                      ((sec, prop, layers.get(sec, prop)) + origin))
 
 # begin helper functions
 
+def layerpaths():
+    """
+    Returns the configuration files Mercurial reads, whether they exist or
+    not, in the order it reads them; later files override earlier ones.
+    """
+    paths = list(util.rcpath()) # a copy, as Mercurial caches the list
+    if 'HGRCPATH' not in os.environ:
+        # with HGRCPATH set, Mercurial reads only the files it names
+        paths.extend(util.os_rcpath())
+    paths.append(repoconfpath())
+    ans = []
+    for path in reversed(paths):
+        path = os.path.abspath(path)
+        if path not in ans:
+            ans.insert(0, path) # a file read twice counts where read last
+    return ans
+
+
 def verifypaths(paths):
     paths = list(set(paths)) #eliminate duplicates
-    return [os.path.abspath(f) for f in paths if os.path.isfile(f)]
+    found = parallel(os.path.isfile, paths)
+    return [os.path.abspath(f) for f, (isfile, err) in zip(paths, found)
+            if isfile]
+
+
+def parallel(func, items, workers=8):
+    """
+    Calls func on every item, on up to workers threads at once, so that
+    waiting for slow (e.g. network) file systems overlaps. Returns a
+    (result, exception) pair for each item, in the order of items.
+    """
+    results = [None] * len(items)
+    queue = Queue.Queue()
+    for job in enumerate(items):
+        queue.put(job)
+    def work():
+        while True:
+            try:
+                i, item = queue.get_nowait()
+            except Queue.Empty:
+                return
+            try:
+                results[i] = (func(item), None)
+            except Exception, inst:
+                results[i] = (None, inst)
+    if len(items) < 2:
+        work()
+        return results
+    threads = [threading.Thread(target=work)
+               for i in range(min(workers, len(items)))]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    return results
 
 
 def savepretty(conf, path):
     conf.data.clean_format()
-    with open(path, 'wb') as cfg:
-        conf.write(cfg)
+    writefile(path, conf.write)
+
+
+class hashingfile(object):
+    """
+    Passes writes on to a file, keeping the size and a hash of everything
+    written.
+    """
+    def __init__(self, fp):
+        self.fp = fp
+        self.size = 0
+        self.hash = sha1()
+
+    def write(self, data):
+        self.fp.write(data)
+        self.size += len(data)
+        self.hash.update(data)
+
+
+def filedigest(path, size):
+    """
+    Returns the hash of the file at path, or None if it doesn't exist or
+    isn't size bytes long.
+    """
+    try:
+        if os.path.getsize(path) != size:
+            return None
+        h = sha1()
+        with open(path, 'rb') as f:
+            while True:
+                data = f.read(65536)
+                if not data:
+                    break
+                h.update(data)
+    except (IOError, OSError):
+        return None
+    return h.digest()
+
+
+def writefile(path, write, old=None):
+    """
+    Calls write with a file to write the new contents of path to, and
+    puts them in place unless the file holds them already (old, if given,
+    is taken to be its current contents). The contents go to a temporary
+    file that then replaces path, so that readers never see a partly
+    written file, and are never held in memory as a whole. Returns
+    whether the file was written.
+    """
+    path = os.path.realpath(path) # replace the target of a symlink
+    try:
+        mode = stat.S_IMODE(os.stat(path).st_mode)
+    except OSError:
+        umask = os.umask(0)
+        os.umask(umask)
+        mode = 0666 & ~umask
+    fd, tmp = tempfile.mkstemp(dir=os.path.dirname(path),
+                               prefix='.%s-' % os.path.basename(path))
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            out = hashingfile(f)
+            write(out)
+            if old is not None:
+                unchanged = (len(old) == out.size and
+                             sha1(old).digest() == out.hash.digest())
+            else:
+                unchanged = filedigest(path, out.size) == out.hash.digest()
+            if not unchanged:
+                f.flush()
+                os.fsync(f.fileno())
+        if unchanged:
+            os.unlink(tmp)
+            return False
+        os.chmod(tmp, mode)
+        if os.name != 'posix' and os.path.exists(path):
+            os.unlink(path) # rename() can't replace a file there
+        os.rename(tmp, path)
+    except:
+        try:
+            os.unlink(tmp)
+        except OSError:
+            pass
+        raise
+    return True
+
+
+def newconf(ui):
+    """
+    Returns an empty parser. If a cache directory is configured with
+    cedit.cache, files that have not changed since they were last read
+    are loaded from the cache instead of being parsed again.
+    """
+    cachedir = ui.config('cedit', 'cache')
+    if not cachedir:
+        return SafeConfigParser(lazy=True)
+    cachesize = ui.config('cedit', 'cachesize')
+    if cachesize:
+        cache = ParseCache(os.path.expanduser(cachedir),
+                           int(cachesize) * 1024)
+    else:
+        cache = ParseCache(os.path.expanduser(cachedir))
+    return SafeConfigParser(lazy=True, cache=cache)
+
+
+def loadconf(ui, path, sec):
+    """
+    Returns a parser for the configuration at path, and a function
+    that saves it back. When section sec is present, only the blocks
+    of that section are parsed, and saving splices them back into the
+    file, leaving the rest of it untouched.
+    """
+    try:
+        with open(path) as cfg:
+            data = cfg.read()
+    except IOError:
+        data = ""
+    index = SectionIndex(data)
+    span = index.span(sec, data)
+    if span is None or 'DEFAULT' in index:
+        # [DEFAULT] values show through in every section, so the
+        # whole file is needed to see the section as it really is
+        conf = newconf(ui)
+        conf.read(path)
+        return conf, lambda: savepretty(conf, path)
+    conf = SafeConfigParser(lazy=True)
+    read_section(conf.data, data, span, path)
+    return conf, lambda: savesection(conf, path, data, span)
+
+
+def loadconfs(ui, paths, sec):
+    """
+    Runs loadconf for every path in parallel, and yields (path, conf, save)
+    for each in the order of paths. Files that fail to load are reported
+    and skipped.
+    """
+    loaded = parallel(lambda path: loadconf(ui, path, sec), paths)
+    for path, (result, err) in zip(paths, loaded):
+        if err is not None:
+            ui.warn(_("Unable to load %s: %s\n") % (path, err))
+        else:
+            yield (path,) + result
+
+
+def savesection(conf, path, data, span):
+    conf.data.clean_format(span[1] == len(data))
+    text = splice_section(conf.data, data, span)
+    writefile(path, lambda f: f.write(text), data)
 
 
 def repoconfpath():
-    cwd = os.path.abspath(os.getcwd())
-    return os.path.join(cwd, ".hg", "hgrc")
+    root = findrepo() or os.path.abspath(os.getcwd())
+    return os.path.join(root, ".hg", "hgrc")
 
 
 def existslocalrepo():
-    return os.path.exists(os.path.join(os.getcwd(), ".hg"))
+    return findrepo() is not None
 
 
 def checkexists(path, pathtype, ui):
@@ -261,12 +689,15 @@ class hgconfig(object):
     """
     This class implements all of the logic for the interactive editor.
     """
-    _opts = ['&add', '&delete', '&view', 're&load', '&write', '&quit', '&help']
+    _opts = ['&add', '&delete', '&view', '&origin', '&changes', '&undo',
+             '&redo', '&switch', 're&load', '&write', 'writ&e all', '&quit',
+             '&help']
     _help =_(
 """
 Mercurial configuration editor extension.
 
-A '*' before the prompt denotes unsaved changes. See
+A '*' before the prompt denotes unsaved changes. Several configurations
+can be open at once; each keeps its own changes until it is written. See
 http://www.selenic.com/mercurial/hgrc.5.html or 'man 5 hgrc'
 for more information on configuration files.
 
@@ -274,9 +705,15 @@ Commands:
 a       add to or modify your configuration
 d       delete/remove a section or property from your configuration
 v       view current configuration, including changes
+o       show where the value Mercurial uses for a property is set
+c       list the changes made since the configuration was loaded
+u       undo the last change
+r       redo the last undone change
+s       switch to another configuration, keeping unsaved changes
 w       write/save to file
+e       write every configuration with unsaved changes
 q       quit
-l       load a configuration from disk
+l       load a configuration from disk, discarding its unsaved changes
 h       view this help screen
 """)
     _dirty = False
@@ -284,11 +721,26 @@ h       view this help screen
     _conf = None
     _path = ""
     _paths = []
+    # Every change is journaled as (description, undo ops, redo ops),
+    # with the ops in the form taken by SafeConfigParser.apply() and
+    # replayed by applyops().
+    # _saved is the length of _undo when the file was last written,
+    # or None if that state can no longer be reached by undo/redo.
+    _undo = []
+    _redo = []
+    _saved = 0
+    # The configurations open besides the one being edited, mapped from
+    # path to (conf, dirty, undo, redo, saved)
+    _docs = {}
+    # the merged view of all configuration files on disk, for 'o'
+    _layers = None
 
     def __init__(self, ui):
         self._ui = ui
+        self._docs = {}
         self.setpaths()
-        self.reloadconf()
+        self.loadall()
+        self.opendoc(self.selectpath())
         self.printhelp()
         while True:
             index = self._ui.promptchoice(self.getPrompt(),
@@ -296,19 +748,43 @@ h       view this help screen
             [self.modsection,
             self.delsection,
             self.viewconf,
+            self.vieworigin,
+            self.viewchanges,
+            self.undo,
+            self.redo,
+            self.switchconf,
             self.reloadconf,
             self.writeconf,
+            self.writeall,
             self.exitext,
             self.printhelp][index]()
 
     def setpaths(self):
-        paths = util.rcpath()
+        # every file that can be edited, not only those Mercurial reads
+        # with the current HGRCPATH
+        paths = list(util.rcpath()) # a copy, as Mercurial caches the list
         paths.extend(util.os_rcpath())
         paths.append(repoconfpath())
         self._paths = verifypaths(paths)
         if existslocalrepo():
             self.checkpath(repoconfpath(), "repository")
 
+    def loadall(self):
+        """Reads every configuration file at once, so switching is instant"""
+        for path, (conf, err) in zip(self._paths,
+                                     parallel(self.readconf, self._paths)):
+            if err is not None:
+                self._ui.warn(_("Unable to load %s: %s\n") % (path, err))
+            else:
+                self._docs[path] = (conf, False, [], [], 0)
+                self._ui.status(_("Configuration at '%s' loaded.\n") % path)
+
+    def readconf(self, path):
+        conf = newconf(self._ui)
+        conf.read(path)
+        conf.data.clean_format()
+        return conf
+
     def checkpath(self, path, pathtype):
         if path not in self._paths and self._ui.promptchoice(_("No %s "+
         "configuration found. Would you like to create one (at %s) [y n]?")%
@@ -320,18 +796,27 @@ h       view this help screen
     def modsection(self):
         """Adds or modifies sections and properties to current configuration"""
         sec = self._ui.prompt(_("Enter section name: "), "")
-        if sec not in self._conf.sections():
+        created = sec not in self._conf.sections()
+        if created:
             self._conf.add_section(sec)
         prop = self._ui.prompt(_("Enter property name: "), "")
-        try:
-            old_val = _(" (currently '%s'): ") % self._conf.get(sec, prop)
-        except NoOptionError:
+        cur_val = self._conf.lookup(sec, prop, raw=True)
+        if cur_val is None:
             old_val = ": "
+        else:
+            old_val = _(" (currently '%s'): ") % cur_val
         val = self._ui.prompt(_("Enter property value %s") % old_val, "")
+        if created:
+            undo = [('remove_section', sec)]
+        elif self._conf.optionxform(prop) in self._conf.own_options(sec):
+            undo = [('set', sec, prop, self._conf.get(sec, prop, raw=True))]
+        else:
+            undo = [('remove_option', sec, prop)]
         self._conf.set(sec, prop, val)
         self._conf.data.clean_format()
         self._ui.status(_("Value set\n"))
-        self._dirty = True
+        self.record("set %s.%s = %s" % (sec, prop, val), undo,
+                    [('set', sec, prop, val)])
 
     def delsection(self):
         self._ui.status(_("Delete an entire (s)ection or a single (p)roperty"+
@@ -347,10 +832,13 @@ h       view this help screen
                 if prop not in self._conf.options(sec):
                     self._ui.warn(_("Property '%s' not found\n") % prop)
                     return
+                old_val = self._conf.get(sec, prop, raw=True)
                 removed = self._conf.remove_option(sec, prop)
                 if removed:
                     self._ui.status(_("Property removed\n"))
-                    self._dirty = True
+                    self.record("remove %s.%s" % (sec, prop),
+                                [('set', sec, prop, old_val)],
+                                [('remove_option', sec, prop)])
                 else:
                     self._ui.warn(_("Unable to remove property '%s'\n") % prop)
             except NoSectionError:
@@ -360,10 +848,15 @@ h       view this help screen
             if sec not in self._conf.sections():
                 self._ui.warn(_("Section '%s' not found\n") % sec)
                 return
+            undo = [('add_section', sec)]
+            for prop in self._conf.own_options(sec):
+                undo.append(('set', sec, prop,
+                             self._conf.get(sec, prop, raw=True)))
             removed = self._conf.remove_section(sec)
             if removed:
                 self._ui.status(_("Section removed\n"))
-                self._dirty = True
+                self.record("remove [%s]" % sec, undo,
+                            [('remove_section', sec)])
             else:
                 self._ui.warn(_("Unable to remove section '%s'\n") % sec)
 
@@ -374,24 +867,118 @@ h       view this help screen
             self._ui.status(_("(Empty configuration)"))
         self._ui.status("%s\n" % confstr)
 
+    def vieworigin(self):
+        sec = self._ui.prompt(_("Enter section name: "), "")
+        prop = self._ui.prompt(_("Enter property name "
+                                 "(empty for the whole section): "), "")
+        if self._layers is None:
+            self._layers = LayeredConfig(layerpaths())
+        else:
+            self._layers.refresh()
+        showorigin(self._ui, self._layers, prop and "%s.%s" % (sec, prop)
+                   or sec)
+
+    def viewchanges(self):
+        entries = [desc for desc, undo, redo in self._undo]
+        entries.extend([_("(undone) %s") % desc
+                        for desc, undo, redo in reversed(self._redo)])
+        if not entries:
+            self._ui.status(_("No changes\n"))
+            return
+        for i, desc in enumerate(entries):
+            if i and i == self._saved:
+                self._ui.status(_("  -- written to disk --\n"))
+            self._ui.status("  %s\n" % desc)
+        if self._saved == len(entries):
+            self._ui.status(_("  -- written to disk --\n"))
+
+    def record(self, desc, undo, redo):
+        """Journals a change that applyops(undo) reverses"""
+        if self._saved is not None and self._saved > len(self._undo):
+            self._saved = None
+        self._undo.append((desc, undo, redo))
+        self._redo = []
+        self._dirty = True
+
+    def undo(self):
+        if not self._undo:
+            self._ui.warn(_("Nothing to undo\n"))
+            return
+        desc, undo, redo = self._undo[-1]
+        if self.applyops(desc, undo):
+            self._redo.append(self._undo.pop())
+            self._dirty = len(self._undo) != self._saved
+            self._ui.status(_("Undone: %s\n") % desc)
+
+    def redo(self):
+        if not self._redo:
+            self._ui.warn(_("Nothing to redo\n"))
+            return
+        desc, undo, redo = self._redo[-1]
+        if self.applyops(desc, redo):
+            self._undo.append(self._redo.pop())
+            self._dirty = len(self._undo) != self._saved
+            self._ui.status(_("Redone: %s\n") % desc)
+
+    def applyops(self, desc, ops):
+        """
+        Replays journaled ops. The values were already in the file or
+        were accepted by set(), so they are not checked again (a lone %
+        is common in hgrc files), and only the options touched are
+        changed, without a snapshot of the whole file.
+        """
+        conf = self._conf
+        try:
+            for op in ops:
+                if op[0] == 'set':
+                    if not conf.has_section(op[1]):
+                        conf.add_section(op[1])
+                    RawConfigParser.set(conf, op[1], op[2], op[3])
+                elif op[0] == 'remove_option':
+                    RawConfigParser.remove_option(conf, op[1], op[2])
+                elif op[0] == 'add_section':
+                    conf.add_section(op[1])
+                else:
+                    RawConfigParser.remove_section(conf, op[1])
+            conf.data.clean_format()
+        except (ConfigError, ValueError, TypeError), inst:
+            self._ui.warn(_("Unable to replay '%s': %s\n") % (desc, inst))
+            return False
+        return True
+
     def reloadconf(self):
-        if self.warnflush('load a new configuration'):
+        path = self.selectpath()
+        if self.warnflush('load a new configuration', self.isdirty(path)):
             return
-        self._conf = SafeConfigParser()
+        if path == self._path:
+            self._conf = None
+        else:
+            self._docs.pop(path, None)
+        self.opendoc(path)
+
+    def switchconf(self):
+        path = self.selectpath()
+        if path != self._path:
+            self.opendoc(path)
+            self._ui.status(_("Editing configuration at '%s'.\n") % path)
+
+    def selectpath(self):
         if len(self._paths) > 1:
             self._ui.status(_("\nSelect configuration to edit:\n"))
             for i in range(len(self._paths)):
-                print " %s.  %s" % (str(i), self.pathclass(self._paths[i]))
+                mark = self.isdirty(self._paths[i]) and "*" or " "
+                print " %s. %s%s" % (str(i), mark,
+                                     self.pathclass(self._paths[i]))
             index = self._ui.promptchoice(self.getPrompt(),
             ["&" + str(num) for num in range(len(self._paths))],
             len(self._paths) - 1)
-            self._path = self._paths[index]
+            return self._paths[index]
         elif len(self._paths) == 1:
-            self._path = self._paths[0]
+            return self._paths[0]
         else:
             # This is a little silly, since without a valid config file
             # how could this extension be loaded? But for completeness...
-            self._path = default = util.user_rcpath()[0]
+            default = util.user_rcpath()[0]
             msg = _("Unable to find configuration file."
                     " Would you like to make one at %s?") % default
             index = self._ui.promptchoice(msg, [_('&yes'), _('&no')], 0)
@@ -399,24 +986,62 @@ h       view this help screen
                 self._ui.status(_("No configuration to edit"))
                 sys.exit(0)
             open(default, "ab")
-        self._conf.read((self._path))
-        self._conf.data.clean_format()
+            return default
+
+    def opendoc(self, path):
+        """
+        Makes path the configuration being edited. The previous one stays
+        open with its changes, and path is only read from disk if it
+        isn't open already.
+        """
+        if self._conf is not None:
+            self._docs[self._path] = (self._conf, self._dirty, self._undo,
+                                      self._redo, self._saved)
+        self._path = path
+        if path in self._docs:
+            (self._conf, self._dirty, self._undo,
+             self._redo, self._saved) = self._docs.pop(path)
+            return
+        self._conf = self.readconf(path)
         self._dirty = False
+        self._undo = []
+        self._redo = []
+        self._saved = 0
         self._ui.status(_("Configuration at '%s' loaded.\n") % self._path)
 
+    def isdirty(self, path):
+        if path == self._path:
+            return self._dirty
+        return path in self._docs and self._docs[path][1]
+
     def writeconf(self):
-        with open(self._path, 'wb') as cfg:
-            self._conf.write(cfg)
+        savepretty(self._conf, self._path)
         self._ui.status(_("Configuration written to %s\n") % self._path)
         self._dirty = False
+        self._saved = len(self._undo)
+
+    def writeall(self):
+        written = False
+        for path, (conf, dirty, undo, redo, saved) in self._docs.items():
+            if dirty:
+                savepretty(conf, path)
+                self._ui.status(_("Configuration written to %s\n") % path)
+                self._docs[path] = (conf, False, undo, redo, len(undo))
+                written = True
+        if self._dirty:
+            self.writeconf()
+        elif not written:
+            self._ui.status(_("No unsaved changes\n"))
 
     def exitext(self):
-        if self.warnflush('quit'):
+        dirty = self._dirty or [path for path in self._docs
+                                if self.isdirty(path)]
+        if self.warnflush('quit', dirty):
             return
         sys.exit(0)
 
-    def warnflush(self, action):
-        return self._dirty and self._ui.promptchoice("You have unsaved "
+    def warnflush(self, action, dirty):
+        return dirty and self._ui.promptchoice("You have unsaved "
              "changes.\nReally %s before saving [y n]?" % action,
              ['&yes', '&no'], 1)
 
@@ -442,12 +1067,24 @@ h       view this help screen
 commands.norepo += " setuser cedit"
 cmdtable = {
     "cedit": (hgrccli,
-                [('a', 'add', '', _("Add/Set configuration property. Takes " +
+                [('a', 'add', [], _("Add/Set configuration property. Takes " +
                  "a string with format: '<section>.<property> = <value>'")),
-                  ('d', 'delete', '', _("Delete from configuration. Pass" +
+                  ('d', 'delete', [], _("Delete from configuration. Pass" +
                   " section's name to remove entire section or " +
                   "'<section>.<prop>' to remove a single property")),
+                  ('o', 'operations', '', _("Read add and delete " +
+                  "operations from a file, one per line, or from standard " +
+                  "input if the file is '-'")),
+                  ('', 'fleet', [], _("target the configuration of every " +
+                  "repository in or under the given directory")),
+                  ('j', 'jobs', 0, _("number of processes for --fleet " +
+                  "(default: one per CPU)")),
+                  ('', 'nested', False, _("with --fleet, also look for " +
+                  "repositories inside the working directories of others")),
                   ('e', 'env', False, _('target first path in HGRCPATH')),
+                  ('w', 'where', '', _("Show the value Mercurial uses for " +
+                  "'<section>.<prop>', or every property of a section, and " +
+                  "the file and line that set it")),
                  ('u', 'user', False, _('target user configuration')),
                  ('g', 'global', False, _("target global/system-wide " +
                  "configuration")),
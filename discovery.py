@@ -0,0 +1,120 @@
+# discovery.py - finding Mercurial repositories for cedit.
+#
+# Copyright 2010 Paul Lambert <paul@matygo.com>
+#
+# This software may be used and distributed according to the terms of the
+# GNU General Public License version 2, incorporated herein by reference.
+
+'''
+Finding Mercurial repositories.
+
+findrepo() finds the repository a directory is in, by looking for
+.hg in it and in each of its parents. repositoryscanner finds every
+repository under a set of directories, listing directories on several
+threads at once and, unless asked for nested repositories, not looking
+inside the working directory of a repository it has found.
+'''
+import os
+import threading
+import Queue
+
+try:
+    from scandir import scandir
+except ImportError:
+    scandir = getattr(os, 'scandir', None)
+
+
+def findrepo(path=None):
+    """
+    Returns the root of the repository containing path (by default the
+    current directory), or None if it isn't in one.
+    """
+    path = os.path.abspath(path or os.getcwd())
+    while True:
+        if os.path.isdir(os.path.join(path, '.hg')):
+            return path
+        parent = os.path.dirname(path)
+        if parent == path:
+            return None
+        path = parent
+
+
+class repositoryscanner(object):
+    """
+    Finds the repositories under a set of directories.
+    """
+    def __init__(self, workers=8):
+        self.workers = workers
+
+    def scan(self, roots, nested=False):
+        """
+        Returns every repository in or under the directories in roots,
+        in sorted order. Repositories inside the working directory of
+        another are only found if nested is true. Symbolic links to
+        directories are not followed.
+        """
+        found = set()
+        queue = Queue.Queue()
+        for root in roots:
+            queue.put(os.path.abspath(os.path.expanduser(root)))
+        def work():
+            while True:
+                path = queue.get()
+                if path is None:
+                    return
+                try:
+                    try:
+                        isrepo, subdirs = self.listdir(path)
+                    except OSError:
+                        continue
+                    if isrepo:
+                        found.add(path)
+                        if not nested:
+                            continue
+                    for subdir in subdirs:
+                        queue.put(subdir)
+                finally:
+                    queue.task_done()
+        threads = [threading.Thread(target=work)
+                   for i in range(self.workers)]
+        for t in threads:
+            t.setDaemon(True)
+            t.start()
+        queue.join()
+        for t in threads:
+            queue.put(None)
+        for t in threads:
+            t.join()
+        return sorted(found)
+
+    def listdir(self, path):
+        """
+        Returns whether path is the root of a repository, and the
+        directories in it apart from .hg
+        """
+        isrepo = False
+        subdirs = []
+        if scandir is not None:
+            for entry in scandir(path):
+                if entry.is_dir(follow_symlinks=False):
+                    if entry.name == '.hg':
+                        isrepo = True
+                    else:
+                        subdirs.append(entry.path)
+        else:
+            for name in os.listdir(path):
+                full = os.path.join(path, name)
+                if os.path.isdir(full) and not os.path.islink(full):
+                    if name == '.hg':
+                        isrepo = True
+                    else:
+                        subdirs.append(full)
+        return isrepo, subdirs
+
+
+def findrepos(roots, nested=False):
+    """
+    Returns every repository in or under the directories in roots, in
+    sorted order, looking inside repositories only if nested is true
+    """
+    return repositoryscanner().scan(roots, nested)
@@ -6,8 +6,13 @@
 from ini import INIConfig
 from config import BasicConfig, ConfigNamespace
 from compat import RawConfigParser, ConfigParser, SafeConfigParser
+from index import SectionIndex
+from cache import ParseCache
+from events import iterparse
+from layers import LayeredConfig
 
 __all__ = [
     'INIConfig', 'BasicConfig', 'ConfigNamespace',
     'RawConfigParser', 'ConfigParser', 'SafeConfigParser',
+    'SectionIndex', 'ParseCache', 'iterparse', 'LayeredConfig',
 ]
@@ -0,0 +1,212 @@
+"""Persistent cache of parsed INI files
+
+A ParseCache stores the parsed lines of every file read through it in
+a directory, so that reading an unchanged file again skips parsing.
+An entry is keyed by the file's path and is only used if the file's
+modification time, size and a hash of its contents all still match.
+The directory is kept under a size limit by evicting the least
+recently used entries.  A file whose entry would be larger than the
+whole limit on its own is parsed as usual but never stored; with the
+default limit of 64 MB that only happens to files of well over ten
+megabytes.
+
+    >>> import tempfile
+    >>> from iniparse import RawConfigParser
+    >>> cache = ParseCache(tempfile.mkdtemp())
+    >>> path = tempfile.mktemp()
+    >>> open(path, 'w').write('[ui]\\nverbose = 1\\n')
+    >>> for i in range(2):
+    ...     cfg = RawConfigParser(cache=cache)
+    ...     files = cfg.read(path)
+    ...     print cfg.get('ui', 'verbose')
+    1
+    1
+"""
+
+import os
+import marshal
+import tempfile
+from hashlib import sha1
+
+from ini import split_lines, EmptyLine, CommentLine, SectionLine, \
+                OptionLine, ContinuationLine
+
+_VERSION = 2
+
+# Record code and constructor arguments (apart from the line
+# itself, which comes last) for every line type
+_line_fields = {
+    EmptyLine: ('e', ()),
+    CommentLine: ('c', ('comment', 'separator')),
+    SectionLine: ('s', ('name', 'comment', 'comment_separator',
+                        'comment_offset')),
+    OptionLine: ('o', ('name', 'value', 'separator', 'comment',
+                       'comment_separator', 'comment_offset')),
+    ContinuationLine: ('k', ('value', 'value_offset')),
+}
+
+_line_classes = dict((code, cls)
+                     for cls, (code, fields) in _line_fields.iteritems())
+
+# Lines read in lazy mode whose fields have not been parsed yet are
+# recorded as their name and text only
+_lazy_codes = {SectionLine: 'S', OptionLine: 'O'}
+_lazy_classes = dict((code, cls) for cls, code in _lazy_codes.iteritems())
+
+
+def _unparsed(lineobj):
+    fields = lineobj._lazy_fields
+    if not fields:
+        return False
+    try:
+        object.__getattribute__(lineobj, fields[0])
+    except AttributeError:
+        return True
+    return False
+
+
+def _dump_line(line, lineobj):
+    if lineobj is None:
+        # unparseable line - keep its text for error handling
+        return ('?', line)
+    if _unparsed(lineobj):
+        return (_lazy_codes[lineobj.__class__], lineobj.name, lineobj.line)
+    code, fields = _line_fields[lineobj.__class__]
+    return ((code,) + tuple([getattr(lineobj, f) for f in fields]) +
+            (lineobj.line,))
+
+
+def _load_lines(records, lazy):
+    lines = []
+    lineobjs = []
+    for record in records:
+        code = record[0]
+        if code == '?':
+            lines.append(record[1])
+            lineobjs.append(None)
+            continue
+        if code in _lazy_classes:
+            cls = _lazy_classes[code]
+            if lazy:
+                lineobj = cls.lazy(record[1], record[2])
+            else:
+                lineobj = cls.parse(record[2])
+        else:
+            lineobj = _line_classes[code](*record[1:])
+        lines.append(lineobj.line)
+        lineobjs.append(lineobj)
+    return lines, lineobjs
+
+
+class ParseCache(object):
+    def __init__(self, directory, maxsize=64*1024*1024):
+        self.directory = directory
+        self.maxsize = maxsize
+
+    def _entry(self, path):
+        if isinstance(path, unicode):
+            path = path.encode('utf-8')
+        return os.path.join(self.directory, sha1(path).hexdigest())
+
+    def _key(self, path, data):
+        st = os.stat(path)
+        if isinstance(data, unicode):
+            digest = sha1(data.encode('utf-8')).hexdigest()
+        else:
+            digest = sha1(data).hexdigest()
+        return (path, st.st_mtime, st.st_size, digest)
+
+    def readfp(self, cfg, fp, path):
+        """Read fp, the open file at path, into the INIConfig cfg"""
+        try:
+            fname = fp.name
+        except AttributeError:
+            fname = path
+        path = os.path.abspath(path)
+        data = fp.read()
+        entry = self._entry(path)
+        key = self._key(path, data)
+        cached = self._lookup(entry, key)
+        if cached is not None:
+            bom, records = cached
+            lines, lineobjs = _load_lines(records, cfg._lazy)
+            if bom:
+                cfg._bom = True
+            cfg._load(fname, lines, lineobjs)
+            return
+        bom = isinstance(data, unicode) and data[:1] == u'\ufeff'
+        lines = split_lines(data)
+        lineobjs = cfg._parse_lines(lines)
+        # Only files that load without errors are stored
+        cfg._load(fname, lines, lineobjs)
+        records = [_dump_line(line, lineobj)
+                   for line, lineobj in zip(lines, lineobjs)]
+        self._store(entry, key, bom, records)
+
+    def _lookup(self, entry, key):
+        try:
+            f = open(entry, 'rb')
+            try:
+                cached = marshal.load(f)
+            finally:
+                f.close()
+        except (IOError, EOFError, ValueError, TypeError):
+            return None
+        if (not isinstance(cached, tuple) or len(cached) != 4 or
+                cached[0] != _VERSION or cached[1] != key):
+            return None
+        try:
+            os.utime(entry, None)   # mark as recently used
+        except OSError:
+            pass
+        return cached[2:]
+
+    def _store(self, entry, key, bom, records):
+        data = marshal.dumps((_VERSION, key, bom, records))
+        if len(data) > self.maxsize:
+            return
+        try:
+            if not os.path.isdir(self.directory):
+                os.makedirs(self.directory)
+            fd, tmp = tempfile.mkstemp(dir=self.directory, prefix='.tmp')
+        except (IOError, OSError):
+            return
+        try:
+            try:
+                os.write(fd, data)
+            finally:
+                os.close(fd)
+            if os.name != 'posix' and os.path.exists(entry):
+                os.unlink(entry)
+            os.rename(tmp, entry)
+        except (IOError, OSError):
+            try:
+                os.unlink(tmp)
+            except OSError:
+                pass
+            return
+        self._evict()
+
+    def _evict(self):
+        """Remove least recently used entries until under maxsize"""
+        entries = []
+        total = 0
+        for name in os.listdir(self.directory):
+            if len(name) != 40:
+                continue
+            path = os.path.join(self.directory, name)
+            try:
+                st = os.stat(path)
+            except OSError:
+                continue
+            entries.append((st.st_mtime, st.st_size, path))
+            total += st.st_size
+        entries.sort()
+        for mtime, size, path in entries:
+            if total <= self.maxsize:
+                break
+            try:
+                os.unlink(path)
+            except OSError:
+                continue
+            total -= size
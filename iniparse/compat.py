@@ -9,9 +9,105 @@ should be completely identical to the Python standard library
 versions.  Tested with the unit tests included with Python-2.3.4
 
 The underlying INIConfig object can be accessed as cfg.data
+
+lookup() and lookup_many() return a default for a missing section or
+option instead of raising, and fall back to [DEFAULT] as get() does:
+
+    >>> from StringIO import StringIO
+    >>> cfg = ConfigParser()
+    >>> cfg.readfp(StringIO('[DEFAULT]\\nhome = /home/jdoe\\n'
+    ...                     '[ui]\\nignore = %(home)s/.hgignore\\n'))
+    >>> cfg.lookup('ui', 'ignore')
+    '/home/jdoe/.hgignore'
+    >>> cfg.lookup('ui', 'ignore', raw=True)
+    '%(home)s/.hgignore'
+    >>> print cfg.lookup('ui', 'username')
+    None
+    >>> cfg.lookup_many([('ui', 'home'), ('paths', 'default')], '-')
+    ['/home/jdoe', '-']
+
+Changes made in a batch() are undone together if the block raises:
+
+    >>> cfg = RawConfigParser()
+    >>> cfg.readfp(StringIO('[ui]\\nx = 1\\n\\n  more\\n'))
+    >>> try:
+    ...     with cfg.batch():
+    ...         cfg.set('ui', 'x', '2')
+    ...         removed = cfg.remove_section('ui')
+    ...         raise RuntimeError
+    ... except RuntimeError:
+    ...     pass
+    >>> cfg.get('ui', 'x')
+    '1\\nmore'
+    >>> print cfg.data,
+    [ui]
+    x = 1
+    <BLANKLINE>
+      more
+
+apply() checks every operation before making any change:
+
+    >>> cfg.apply([('set', 'paths', 'default', '/repo'),
+    ...            ('remove_option', 'ui', 'x'),
+    ...            ('add_section', 'ui')])
+    Traceback (most recent call last):
+    DuplicateSectionError: Section 'ui' already exists
+    >>> cfg.apply([('set', 'paths', 'default', '/repo'),
+    ...            ('remove_option', 'ui', 'x')])
+    >>> print cfg.data,
+    [ui]
+    <BLANKLINE>
+    [paths]
+    default = /repo
+
+A snapshot() can be changed without affecting the parser it was taken
+from, and keeps its contents when a batch() it was taken in is undone:
+
+    >>> snap = cfg.snapshot()
+    >>> snap.set('paths', 'default', '/other')
+    >>> cfg.get('paths', 'default')
+    '/repo'
+    >>> try:
+    ...     with cfg.batch():
+    ...         cfg.set('ui', 'y', '2')
+    ...         snap = cfg.snapshot()
+    ...         raise RuntimeError
+    ... except RuntimeError:
+    ...     pass
+    >>> cfg.items('ui'), snap.items('ui')
+    ([], [('y', '2')])
+    >>> print snap.data,
+    [ui]
+    y = 2
+    <BLANKLINE>
+    [paths]
+    default = /repo
+
+SafeConfigParser remembers interpolated values, and forgets those that
+depend on an option when it changes, even through [DEFAULT]:
+
+    >>> cfg = SafeConfigParser()
+    >>> cfg.readfp(StringIO('[DEFAULT]\\nroot = /srv\\n'
+    ...                     '[web]\\nbase = %(root)s/www\\n'
+    ...                     'logs = %(base)s/logs\\n'))
+    >>> cfg.get('web', 'logs')
+    '/srv/www/logs'
+    >>> cfg.set('DEFAULT', 'root', '/var')
+    >>> cfg.get('web', 'logs')
+    '/var/www/logs'
+    >>> cfg.set('web', 'base', '%(root)s/html')
+    >>> cfg.get('web', 'logs')
+    '/var/html/logs'
+
+Changes made through cfg.data instead drop every remembered value:
+
+    >>> cfg.data.web.base = '/opt'
+    >>> cfg.get('web', 'logs')
+    '/opt/logs'
 """
 
 import re
+import sys
 from ConfigParser import DuplicateSectionError,    \
                   NoSectionError, NoOptionError,   \
                   InterpolationMissingOptionError, \
@@ -27,10 +123,13 @@ from ConfigParser import Error, InterpolationError, \
 import ini
 
 class RawConfigParser(object):
-    def __init__(self, defaults=None, dict_type=dict):
+    def __init__(self, defaults=None, dict_type=dict, lazy=False,
+                 cache=None):
         if dict_type != dict:
             raise ValueError('Custom dict types not supported')
-        self.data = ini.INIConfig(defaults=defaults, optionxformsource=self)
+        self.data = ini.INIConfig(defaults=defaults, optionxformsource=self,
+                                  lazy=lazy)
+        self._cache = cache
 
     def optionxform(self, optionstr):
         return optionstr.lower()
@@ -68,18 +167,22 @@ class RawConfigParser(object):
 
         The DEFAULT section is not acknowledged.
         """
-        try:
-            self.data[section]
-            return True
-        except KeyError:
-            return False
+        return self.data._get(section) is not None
 
     def options(self, section):
         """Return a list of option names for the given section name."""
-        try:
-            return list(self.data[section])
-        except KeyError:
+        sec = self.data._get(section)
+        if sec is None:
             raise NoSectionError(section)
+        return list(sec)
+
+    def own_options(self, section):
+        """Return the options set in section itself, leaving out any
+        that are only inherited from [DEFAULT]."""
+        sec = self.data._get(section)
+        if sec is None:
+            raise NoSectionError(section)
+        return list(sec._names)
 
     def read(self, filenames):
         """Read and parse a filename or a list of filenames.
@@ -90,6 +193,10 @@ class RawConfigParser(object):
         home directory, systemwide directory), and all existing
         configuration files in the list will be read.  A single
         filename may also be given.
+
+        If the parser was created with a ParseCache, files that are
+        unchanged since they were last read through it are not parsed
+        again.
         """
         files_read = []
         if isinstance(filenames, basestring):
@@ -100,7 +207,10 @@ class RawConfigParser(object):
             except IOError:
                 continue
             files_read.append(filename)
-            self.data._readfp(fp)
+            if self._cache is None:
+                self.data._readfp(fp)
+            else:
+                self._cache.readfp(self.data, fp, filename)
             fp.close()
         return files_read
 
@@ -115,24 +225,34 @@ class RawConfigParser(object):
         self.data._readfp(fp)
 
     def get(self, section, option, vars=None):
-        if not self.has_section(section):
+        sec = self.data._get(section)
+        if sec is None:
             raise NoSectionError(section)
-        if vars is not None and option in vars:
-            value = vars[option]
-        try:
-            sec = self.data[section]
-            return sec._compat_get(option)
-        except KeyError:
+        value = sec._compat_get(option)
+        if value is None:
             raise NoOptionError(option, section)
+        return value
+
+    def lookup(self, section, option, default=None):
+        """Like get(), but return default if section or option is missing"""
+        sec = self.data._get(section)
+        if sec is None:
+            return default
+        return sec._compat_get(option, default)
+
+    def lookup_many(self, keys, default=None):
+        """Return a list of lookup() results for (section, option) pairs"""
+        return [self.lookup(section, option, default)
+                for section, option in keys]
 
     def items(self, section):
-        try:
-            ans = []
-            for opt in self.data[section]:
-                ans.append((opt, self.get(section, opt)))
-            return ans
-        except KeyError:
+        sec = self.data._get(section)
+        if sec is None:
             raise NoSectionError(section)
+        ans = []
+        for opt in sec:
+            ans.append((opt, self.get(section, opt)))
+        return ans
 
     def getint(self, section, option):
         return int(self.get(section, option))
@@ -151,39 +271,145 @@ class RawConfigParser(object):
 
     def has_option(self, section, option):
         """Check for the existence of a given option in a given section."""
-        try:
-            sec = self.data[section]
-        except KeyError:
+        sec = self.data._get(section)
+        if sec is None:
             raise NoSectionError(section)
-        try:
-            sec[option]
-            return True
-        except KeyError:
-            return False
+        return sec._get(option) is not None
 
     def set(self, section, option, value):
         """Set an option."""
-        try:
-            self.data[section][option] = value
-        except KeyError:
+        sec = self.data._get(section)
+        if sec is None:
             raise NoSectionError(section)
+        sec[option] = value
+
+    def snapshot(self):
+        """Return a copy of the parser that can be changed independently
+
+        The copy shares unchanged sections with this parser, so it is
+        much cheaper than reading the file again.
+        """
+        obj = self.__class__.__new__(self.__class__)
+        obj.__dict__.update(self.__dict__)
+        obj.data = self.data._copy()
+        if obj.data._optionxformsource is self:
+            obj.data._optionxformsource = obj
+        if obj.data._sectionxformsource is self:
+            obj.data._sectionxformsource = obj
+        return obj
+
+    def _check_value(self, value):
+        """Raise an exception if set() would not accept value"""
+        pass
+
+    def _set_checked(self, section, option, value):
+        # set() for a value that already passed _check_value()
+        RawConfigParser.set(self, section, option, value)
+
+    def batch(self, clean=True):
+        """Return a context manager that makes its block all-or-nothing
+
+        If the block raises an exception, every change it made to the
+        configuration is undone.  Otherwise the layout is tidied with
+        clean_format() once at the end, unless clean is false.
+
+            with conf.batch():
+                conf.set('ui', 'username', 'jdoe')
+                conf.remove_option('ui', 'verbose')
+        """
+        return _Batch(self, clean)
+
+    def apply(self, ops, clean=True):
+        """Apply a sequence of operations as a single batch()
+
+        Each operation is a tuple: ('set', section, option, value),
+        ('remove_option', section, option), ('add_section', section) or
+        ('remove_section', section).  A set() in a missing section
+        creates the section first.  All operations are checked before
+        any is applied, so invalid values, duplicate sections and the
+        like leave the configuration untouched.
+        """
+        ops = list(ops)
+        self._check_ops(ops)
+        batch = self.batch(clean)
+        batch.__enter__()
+        try:
+            for op in ops:
+                if op[0] == 'set':
+                    section = op[1]
+                    if self.data._get(section) is None:
+                        self.data._new_namespace(section)
+                    self._set_checked(section, op[2], op[3])
+                elif op[0] == 'remove_option':
+                    self.remove_option(op[1], op[2])
+                elif op[0] == 'add_section':
+                    self.add_section(op[1])
+                else:
+                    self.remove_section(op[1])
+        except:
+            exc = sys.exc_info()
+            batch.__exit__(*exc)
+            raise exc[0], exc[1], exc[2]
+        else:
+            batch.__exit__(None, None, None)
+
+    def _check_ops(self, ops):
+        # follow which sections exist as the operations are applied
+        xform = self.data._sectionxform
+        added = {}
+        def exists(section):
+            key = section
+            if xform: key = xform(key)
+            if key in added:
+                return added[key]
+            return self.data._get(section) is not None
+        def mark(section, value):
+            key = section
+            if xform: key = xform(key)
+            added[key] = value
+
+        for op in ops:
+            if op[0] == 'set':
+                if len(op) != 4:
+                    raise ValueError('Invalid operation', op)
+                self._check_value(op[3])
+                if not exists(op[1]):
+                    if op[1].lower() == 'default':
+                        raise ValueError, 'Invalid section name: %s' % op[1]
+                    mark(op[1], True)
+            elif op[0] == 'remove_option':
+                if len(op) != 3:
+                    raise ValueError('Invalid operation', op)
+                if not exists(op[1]):
+                    raise NoSectionError(op[1])
+            elif op[0] == 'add_section':
+                if len(op) != 2:
+                    raise ValueError('Invalid operation', op)
+                if op[1].lower() == 'default':
+                    raise ValueError, 'Invalid section name: %s' % op[1]
+                if exists(op[1]):
+                    raise DuplicateSectionError(op[1])
+                mark(op[1], True)
+            elif op[0] == 'remove_section':
+                if len(op) != 2:
+                    raise ValueError('Invalid operation', op)
+                if op[1] != DEFAULTSECT:
+                    mark(op[1], False)
+            else:
+                raise ValueError('Invalid operation', op)
 
     def write(self, fp):
         """Write an .ini-format representation of the configuration state."""
-        fp.write(str(self.data))
+        self.data._write(fp)
 
     def remove_option(self, section, option):
         """Remove an option."""
-        try:
-            sec = self.data[section]
-        except KeyError:
+        sec = self.data._get(section)
+        if sec is None:
             raise NoSectionError(section)
-        try:
-            sec[option]
-            del sec[option]
+        if sec._remove(option):
             return 1
-        except KeyError:
-            return 0
+        return 0
 
     def remove_section(self, section):
         """Remove a file section."""
@@ -193,6 +419,25 @@ class RawConfigParser(object):
         return True
 
 
+class _Batch(object):
+    def __init__(self, cfg, clean):
+        self.cfg = cfg
+        self.clean = clean
+        self.state = None
+
+    def __enter__(self):
+        self.state = self.cfg.data._snapshot()
+        return self.cfg
+
+    def __exit__(self, type, value, tb):
+        if type is not None:
+            self.cfg.data._restore(self.state)
+        elif self.clean:
+            self.cfg.data.clean_format()
+        self.state = None
+        return False
+
+
 class ConfigDict(object):
     """Present a dict interface to a ini section."""
 
@@ -202,10 +447,37 @@ class ConfigDict(object):
         self.vars = vars
 
     def __getitem__(self, key):
-        try:
-            return RawConfigParser.get(self.cfg, self.section, key, self.vars)
-        except (NoOptionError, NoSectionError):
+        value = RawConfigParser.lookup(self.cfg, self.section, key)
+        if value is None:
             raise KeyError(key)
+        return value
+
+
+class SectionDict(object):
+    """Resolve every option of an ini section, and vars, at once."""
+
+    def __init__(self, cfg, section, vars):
+        self.cfg = cfg
+        self.section = section
+        self.vars = vars
+        values = cfg.data[section]._compat_values()
+        # __name__ always refers to the section (see _compat_get)
+        values.pop('__name__', None)
+        if vars:
+            for key, value in vars.iteritems():
+                values[cfg.optionxform(key)] = value
+        self.values = values
+
+    def __getitem__(self, key):
+        try:
+            return self.values[key]
+        except KeyError:
+            if key == '__name__':
+                return self.cfg.data[self.section]._compat_get(key)
+            xkey = self.cfg.optionxform(key)
+            if xkey == key or xkey not in self.values:
+                raise
+            return self.values[xkey]
 
 
 class ConfigParser(RawConfigParser):
@@ -233,6 +505,20 @@ class ConfigParser(RawConfigParser):
             d = ConfigDict(self, section, vars)
             return self._interpolate(section, option, value, d)
 
+    def lookup(self, section, option, default=None, raw=False):
+        """Like get(), but return default if section or option is missing
+
+        Errors in interpolating the value are still raised.
+        """
+        value = RawConfigParser.lookup(self, section, option)
+        if value is None:
+            return default
+        if raw:
+            return value
+        option = self.optionxform(option)
+        d = ConfigDict(self, section, None)
+        return self._interpolate(section, option, value, d)
+
     def _interpolate(self, section, option, rawval, vars):
         # do the string interpolation
         value = rawval
@@ -268,16 +554,17 @@ class ConfigParser(RawConfigParser):
         if vars is None:
             options = list(self.data[section])
         else:
+            xvars = set([self.optionxform(x) for x in vars])
             options = []
             for x in self.data[section]:
-                if x not in vars:
+                if x not in xvars:
                     options.append(x)
-            options.extend(vars.keys())
+            options.extend(xvars)
 
         if "__name__" in options:
             options.remove("__name__")
 
-        d = ConfigDict(self, section, vars)
+        d = SectionDict(self, section, vars)
         if raw:
             return [(option, d[option])
                     for option in options]
@@ -286,11 +573,34 @@ class ConfigParser(RawConfigParser):
                     for option in options]
 
 
+class _InterpolationFallback(Exception):
+    """Raised when a value can't be expanded from the memo"""
+
+
 class SafeConfigParser(ConfigParser):
     _interpvar_re = re.compile(r"%\(([^)]+)\)s")
     _badpercent_re = re.compile(r"%[^%]|%$")
 
+    # Interpolated values are memoized per section.  _interp_values
+    # maps section -> option -> (value, height), where height is the
+    # nesting depth that expanding the value needs, and _interp_users
+    # maps section -> option -> the options whose values used it.
+    # _interp_templates keeps each raw value parsed into a list of
+    # (literal, reference) pairs.  Everything is dropped if the
+    # INIConfig changes other than through set() and remove_option().
+    _interp_changes = None
+
     def set(self, section, option, value):
+        self._check_value(value)
+        self._set_checked(section, option, value)
+
+    def snapshot(self):
+        obj = ConfigParser.snapshot(self)
+        # the copy starts with a memo of its own
+        obj._interp_changes = None
+        return obj
+
+    def _check_value(self, value):
         if not isinstance(value, basestring):
             raise TypeError("option values must be strings")
         # check for bad percent signs:
@@ -302,14 +612,137 @@ class SafeConfigParser(ConfigParser):
             raise ValueError("invalid interpolation syntax in %r at "
                              "position %d" % (value, m.start()))
 
+    def _set_checked(self, section, option, value):
+        self._interp_sync()
         ConfigParser.set(self, section, option, value)
+        self._interp_forget(section, option)
+
+    def remove_option(self, section, option):
+        self._interp_sync()
+        ans = ConfigParser.remove_option(self, section, option)
+        self._interp_forget(section, option)
+        return ans
+
+    def remove_section(self, section):
+        self._interp_sync()
+        ans = ConfigParser.remove_section(self, section)
+        self._interp_values.pop(section, None)
+        self._interp_users.pop(section, None)
+        self._interp_templates.pop(section, None)
+        self._interp_changes = self.data._changes
+        return ans
+
+    def _interp_sync(self):
+        """Drop the memo if the INIConfig changed behind our back"""
+        if self._interp_changes != self.data._changes:
+            self._interp_values = {}
+            self._interp_users = {}
+            self._interp_templates = {}
+            self._interp_changes = self.data._changes
+
+    def _interp_forget(self, section, option):
+        """Drop the values that depend on option after it changed"""
+        option = self.optionxform(option)
+        if section == DEFAULTSECT:
+            sections = self._interp_values.keys()
+        else:
+            sections = [section]
+        for sec in sections:
+            values = self._interp_values.get(sec)
+            if values is None:
+                continue
+            users = self._interp_users.get(sec, {})
+            stack = [option]
+            while stack:
+                opt = stack.pop()
+                values.pop(opt, None)
+                stack.extend(users.pop(opt, ()))
+        self._interp_changes = self.data._changes
 
     def _interpolate(self, section, option, rawval, vars):
         # do the string interpolation
+        if "%" not in rawval:
+            return rawval
+        if (isinstance(vars, (ConfigDict, SectionDict)) and
+                vars.cfg is self and vars.vars is None):
+            # lookups only go to the config, so the result can be memoized
+            self._interp_sync()
+            try:
+                return self._interp_expand(section, option, rawval, vars, 1)[0]
+            except _InterpolationFallback:
+                # let the plain expansion raise the appropriate error
+                pass
         L = []
         self._interpolate_some(option, L, rawval, section, vars, 1)
         return ''.join(L)
 
+    def _interp_template(self, section, option, rawval):
+        templates = self._interp_templates.setdefault(section, {})
+        cached = templates.get(option)
+        if cached is not None and cached[0] == rawval:
+            return cached[1]
+        template = []
+        rest = rawval
+        while rest:
+            p = rest.find("%")
+            if p < 0:
+                template.append((rest, None))
+                break
+            if p > 0:
+                template.append((rest[:p], None))
+                rest = rest[p:]
+            c = rest[1:2]
+            if c == "%":
+                template.append(("%", None))
+                rest = rest[2:]
+            elif c == "(":
+                m = self._interpvar_match(rest)
+                if m is None:
+                    raise _InterpolationFallback()
+                template.append(('', m.group(1)))
+                rest = rest[m.end():]
+            else:
+                raise _InterpolationFallback()
+        templates[option] = (rawval, template)
+        return template
+
+    def _interp_expand(self, section, option, rawval, map, depth):
+        """Return (value, height) for rawval, the value of option
+
+        This gives the same result as _interpolate_some(), using the
+        memo where possible, and raises _InterpolationFallback in every
+        case where _interpolate_some() would raise an exception.
+        """
+        if depth > MAX_INTERPOLATION_DEPTH:
+            raise _InterpolationFallback()
+        values = self._interp_values.setdefault(section, {})
+        cached = values.get(option)
+        if cached is not None:
+            if depth + cached[1] - 1 > MAX_INTERPOLATION_DEPTH:
+                raise _InterpolationFallback()
+            return cached
+        users = self._interp_users.setdefault(section, {})
+        accum = []
+        height = 1
+        for literal, var in self._interp_template(section, option, rawval):
+            if var is None:
+                accum.append(literal)
+                continue
+            try:
+                v = map[var]
+            except KeyError:
+                raise _InterpolationFallback()
+            if var != '__name__':
+                var = self.optionxform(var)
+            users.setdefault(var, set()).add(option)
+            if "%" in v:
+                v, h = self._interp_expand(section, var, v, map, depth + 1)
+                height = max(height, h + 1)
+            accum.append(v)
+        ans = (''.join(accum), height)
+        values[option] = ans
+        return ans
+
     _interpvar_match = re.compile(r"%\(([^)]+)\)s").match
 
     def _interpolate_some(self, option, accum, rest, section, map, depth):
@@ -32,6 +32,15 @@ class ConfigNamespace(object):
     def _new_namespace(self, name):
         raise NotImplementedError(name)
 
+    # Subclasses should override this with a lookup that doesn't need
+    # an exception to report a missing key
+
+    def _get(self, key, default=None):
+        try:
+            return self.__getitem__(key)
+        except KeyError:
+            return default
+
     # Machinery for converting dotted access into contained access
     #
     # To distinguish between accesses of class members and namespace
@@ -44,10 +53,10 @@ class ConfigNamespace(object):
     # an example.
 
     def __getattr__(self, name):
-        try:
-            return self.__getitem__(name)
-        except KeyError:
+        value = self._get(name, _missing)
+        if value is _missing:
             return Undefined(name, self)
+        return value
 
     def __setattr__(self, name, value):
         try:
@@ -69,6 +78,9 @@ class ConfigNamespace(object):
     def __setstate__(self, state):
         self.__dict__.update(state)
 
+# returned by _get() to distinguish a missing key from one set to None
+_missing = object()
+
 class Undefined(object):
     """Helper class used to hold undefined names until assignment.
 
@@ -167,6 +179,9 @@ class BasicConfig(ConfigNamespace):
     def __getitem__(self, key):
         return self._data[key]
 
+    def _get(self, key, default=None):
+        return self._data.get(key, default)
+
     def __setitem__(self, key, value):
         self._data[key] = value
 
@@ -0,0 +1,70 @@
+"""Event-based parsing of INI files
+
+iterparse() reads a file one line at a time and reports what each line
+is, without building an INIConfig.  It uses the same line grammar as
+INIConfig and runs in constant memory, which suits tools that only
+scan, validate or pick keys out of large or numerous files.
+
+    >>> from StringIO import StringIO
+    >>> sio = StringIO('''# paths
+    ... [paths]
+    ... default = http://example.com/repo
+    ...     extra
+    ...
+    ... oops''')
+    >>> for event, lineno, data in iterparse(sio):
+    ...     print lineno, event, repr(str(data))
+    1 comment '# paths'
+    2 section '[paths]'
+    3 option 'default = http://example.com/repo'
+    4 continuation '    extra'
+    5 blank ''
+    6 error 'oops'
+
+For error events the data is the text of the line; for all others it
+is the LineType object, with fields such as name and value.
+"""
+
+from ini import parse_line, EmptyLine, CommentLine, SectionLine, \
+                OptionLine, ContinuationLine
+
+
+def iterparse(fp):
+    """Generate (event, lineno, data) for each line of fp
+
+    The events are 'section', 'option', 'continuation', 'comment',
+    'blank' and 'error'.  A line is an error where INIConfig would
+    reject it: if it can't be parsed, if it is an option or
+    continuation before the first section header, or if it is a
+    continuation line that does not follow an option.
+    """
+    in_section = False
+    in_option = False
+    lineno = 0
+    while True:
+        line = fp.readline()
+        if not line:
+            return
+        lineno += 1
+        # Check for BOM on first line
+        if lineno == 1 and isinstance(line, unicode):
+            if line[0] == u'\ufeff':
+                line = line[1:]
+
+        lineobj = parse_line(line)
+
+        if isinstance(lineobj, EmptyLine):
+            yield 'blank', lineno, lineobj
+        elif isinstance(lineobj, CommentLine):
+            yield 'comment', lineno, lineobj
+        elif isinstance(lineobj, SectionLine):
+            in_section = True
+            in_option = False
+            yield 'section', lineno, lineobj
+        elif isinstance(lineobj, OptionLine) and in_section:
+            in_option = True
+            yield 'option', lineno, lineobj
+        elif isinstance(lineobj, ContinuationLine) and in_option:
+            yield 'continuation', lineno, lineobj
+        else:
+            yield 'error', lineno, line.rstrip('\n')
@@ -0,0 +1,121 @@
+"""Locate the [section] blocks of INI text without parsing it
+
+A SectionIndex records the offset and length of every [section] block
+in a buffer, found by scanning for header lines only.  With it a single
+section can be parsed, modified and spliced back into the text while
+the rest of the file is never parsed:
+
+    >>> from iniparse.ini import INIConfig
+    >>> data = '[ui]\\nverbose = 1\\n\\n[paths]\\ndefault = /repo\\n'
+    >>> index = SectionIndex(data)
+    >>> index.blocks('paths')
+    [(18, 24)]
+    >>> span = index.span('ui')
+    >>> cfg = INIConfig()
+    >>> read_section(cfg, data, span)
+    >>> cfg.ui.verbose = '0'
+    >>> print splice_section(cfg, data, span),
+    [ui]
+    verbose = 0
+    <BLANKLINE>
+    [paths]
+    default = /repo
+
+Parsing errors in the section give the line numbers in the whole text:
+
+    >>> from ConfigParser import ParsingError
+    >>> data += 'not an option\\n'
+    >>> span = SectionIndex(data).span('paths')
+    >>> try:
+    ...     read_section(INIConfig(), data, span, 'hgrc')
+    ... except ParsingError, e:
+    ...     print e.filename, e.errors
+    hgrc [(6, 'not an option\\n')]
+"""
+
+import re
+
+from ini import split_lines
+
+# SectionLine.regex applied to a whole buffer at once
+_header_regex = re.compile(r'^\[([^]\n]+)\][ \t\r\f\v]*(?:[;#][^\n]*)?$',
+                           re.M)
+
+
+class SectionIndex(object):
+    def __init__(self, data=''):
+        self._entries = []
+        self._blocks = {}
+        offsets = [(m.group(1), m.start())
+                   for m in _header_regex.finditer(data)]
+        for i, (name, offset) in enumerate(offsets):
+            if i + 1 < len(offsets):
+                end = offsets[i+1][1]
+            else:
+                end = len(data)
+            self._entries.append((name, offset, end - offset))
+            self._blocks.setdefault(name, []).append((offset, end - offset))
+
+    def __contains__(self, name):
+        return name in self._blocks
+
+    def sections(self):
+        """Return the section names, in order of first appearance"""
+        seen = set()
+        ans = []
+        for name, offset, length in self._entries:
+            if name not in seen:
+                ans.append(name)
+                seen.add(name)
+        return ans
+
+    def blocks(self, name):
+        """Return (offset, length) for every block headed [name]"""
+        return list(self._blocks.get(name, ()))
+
+    def span(self, name, data=None):
+        """Return the (start, end) range covering all [name] blocks
+
+        The range runs from the first header to the end of the last
+        block.  If data is given, blank lines directly above the first
+        header are included as well, so that clean_format() on the
+        parsed range sees every blank line it could merge.  Returns
+        None if there is no such section.
+        """
+        blocks = self._blocks.get(name)
+        if not blocks:
+            return None
+        start = blocks[0][0]
+        end = blocks[-1][0] + blocks[-1][1]
+        if data is not None:
+            while start:
+                prev = data.rfind('\n', 0, start - 1) + 1
+                if data[prev:start].strip():
+                    break
+                start = prev
+        return start, end
+
+
+def read_section(cfg, data, span, fname='<???>'):
+    """Parse the range given by span from data into the INIConfig cfg
+
+    Parsing errors name fname, the file data was read from, and give
+    line numbers within the whole of data.
+    """
+    start, end = span
+    lines = split_lines(data[start:end])
+    cfg._load(fname, lines, cfg._parse_lines(lines),
+              data.count('\n', 0, start) + 1)
+    if end < len(data):
+        # the range ends with a newline that separates it from the
+        # next header; drop the empty line parsing produces for it
+        del cfg._data.contents[-1]
+
+
+def splice_section(cfg, data, span):
+    """Return data with the range given by span replaced by cfg"""
+    start, end = span
+    text = str(cfg)
+    if end < len(data) and cfg._data.contents:
+        text += '\n'
+    return data[:start] + text + data[end:]
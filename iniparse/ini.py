@@ -38,16 +38,43 @@ Example:
 # Backward-compatiable with ConfigParser
 
 import re
+from itertools import izip
 from ConfigParser import DEFAULTSECT, ParsingError, MissingSectionHeaderError
 
 import config
 
 class LineType(object):
-    line = None
+    # Line objects are created for every line of every file read, so
+    # they use __slots__ rather than carrying a __dict__ each.
+    __slots__ = ('line',)
+
+    # Fields that lines created by lazy() parse out of their text on
+    # first use.  Empty for line types that are always built eagerly.
+    _lazy_fields = ()
 
     def __init__(self, line=None):
         if line is not None:
-            self.line = line.strip('\n')
+            line = line.strip('\n')
+        self.line = line
+
+    def lazy(cls, name, line):
+        """Create a line from its text, deferring parsing of all
+        fields except the name until one of them is used"""
+        obj = cls.__new__(cls)
+        obj.line = line.strip('\n')
+        obj.name = name
+        return obj
+    lazy = classmethod(lazy)
+
+    # Only called for attributes that are not set, which for a lazily
+    # created line means its fields have not been parsed yet.
+    def __getattr__(self, name):
+        if name in self._lazy_fields and self.line is not None:
+            parsed = self.parse(self.line)
+            for field in self._lazy_fields:
+                setattr(self, field, getattr(parsed, field))
+            return getattr(self, name)
+        raise AttributeError(name)
 
     # Return the original line for unmodified objects
     # Otherwise construct using the current attribute values
@@ -57,18 +84,49 @@ class LineType(object):
         else:
             return self.to_string()
 
-    # If an attribute is modified after initialization
-    # set line to None since it is no longer accurate.
-    def __setattr__(self, name, value):
-        if hasattr(self,name):
-            self.__dict__['line'] = None
-        self.__dict__[name] = value
+    # Attributes should be modified after initialization through
+    # update(), which sets line to None since it is no longer accurate.
+    def update(self, **attrs):
+        if self._lazy_fields:
+            # parse a lazy line before its text is thrown away
+            getattr(self, self._lazy_fields[0])
+        for name, value in attrs.iteritems():
+            setattr(self, name, value)
+        self.line = None
+
+    def copy(self):
+        if self._lazy_fields:
+            getattr(self, self._lazy_fields[0])
+        obj = self.__class__.__new__(self.__class__)
+        for cls in self.__class__.__mro__:
+            for name in cls.__dict__.get('__slots__', ()):
+                setattr(obj, name, getattr(self, name))
+        return obj
+
+    # Classes with __slots__ have no __dict__ for pickle to save, so
+    # the slots that are set are saved instead.  Fields of a lazy line
+    # that have not been parsed yet stay unset.
+    def __getstate__(self):
+        state = {}
+        for cls in self.__class__.__mro__:
+            for name in cls.__dict__.get('__slots__', ()):
+                try:
+                    state[name] = cls.__dict__[name].__get__(self, cls)
+                except AttributeError:
+                    pass
+        return state
+
+    def __setstate__(self, state):
+        for name, value in state.iteritems():
+            setattr(self, name, value)
 
     def to_string(self):
         raise Exception('This method must be overridden in derived classes')
 
 
 class SectionLine(LineType):
+    __slots__ = ('name', 'comment', 'comment_separator', 'comment_offset')
+    _lazy_fields = ('comment', 'comment_separator', 'comment_offset')
     regex =  re.compile(r'^\['
                         r'(?P<name>[^]]+)'
                         r'\]\s*'
@@ -101,6 +159,11 @@ class SectionLine(LineType):
 
 
 class OptionLine(LineType):
+    __slots__ = ('name', 'value', 'separator', 'comment',
+                 'comment_separator', 'comment_offset')
+    _lazy_fields = ('value', 'separator', 'comment',
+                    'comment_separator', 'comment_offset')
+
     def __init__(self, name, value, separator=' = ', comment=None,
                  comment_separator=None, comment_offset=-1, line=None):
         super(OptionLine, self).__init__(line)
@@ -127,10 +190,13 @@ class OptionLine(LineType):
         m = cls.regex.match(line.rstrip())
         if m is None:
             return None
+        return cls._build(m.group('name'), m.group('sep'),
+                          m.group('value'), m.start('value'), line)
+    parse = classmethod(parse)
 
-        name = m.group('name').rstrip()
-        value = m.group('value')
-        sep = m.group('name')[len(name):] + m.group('sep')
+    def _build(cls, rawname, sep, value, value_start, line):
+        name = rawname.rstrip()
+        sep = rawname[len(name):] + sep
 
         # comments are not detected in the regex because
         # ensuring total compatibility with ConfigParser
@@ -148,17 +214,18 @@ class OptionLine(LineType):
             comment = value[coff+1:]
             csep = value[coff]
             value = value[:coff].rstrip()
-            coff = m.start('value') + coff
+            coff = value_start + coff
         else:
             comment = None
             csep = None
             coff = -1
 
         return cls(name, value, sep, comment, csep, coff, line)
-    parse = classmethod(parse)
+    _build = classmethod(_build)
 
 
 class CommentLine(LineType):
+    __slots__ = ('comment', 'separator')
 # Mercurial-safe comment line regex, as given by Steve Borho
 # bitbucket.org/tortoisehg/stable/src/tip/tortoisehg/hgtk/thgconfig.py#cl-1084
     regex = re.compile(r'^(?P<csep>[%;#])(?P<comment>.*)$')
@@ -180,6 +247,8 @@ class CommentLine(LineType):
 
 
 class EmptyLine(LineType):
+    __slots__ = ()
+
     # could make this a singleton
     def to_string(self):
         return ''
@@ -193,6 +262,7 @@ class EmptyLine(LineType):
 
 
 class ContinuationLine(LineType):
+    __slots__ = ('value', 'value_offset')
     regex = re.compile(r'^\s+(?P<value>.*)$')
 
     def __init__(self, value, value_offset=None, line=None):
@@ -213,16 +283,121 @@ class ContinuationLine(LineType):
     parse = classmethod(parse)
 
 
+# The grammars of the line types above folded into a single regex, so
+# that a line can be classified and its fields captured with one match.
+# The alternatives are in the order INIConfig used to try the individual
+# line types, and must be kept in sync with the per-class regexes.
+_line_regex = re.compile(r'^(?:'
+    r'(?P<comment_line>(?P<c_csep>[%;#])(?P<c_comment>.*))|'
+    r'(?P<section_line>\[(?P<s_name>[^]]+)\]\s*'
+        r'((?P<s_csep>;|#)(?P<s_comment>.*))?)|'
+    r'(?P<option_line>(?P<o_name>[^:=\s[][^:=]*)(?P<o_sep>[:=]\s*)'
+        r'(?P<o_value>.*))|'
+    r'(?P<continuation_line>\s+(?P<k_value>.*))'
+    r')$')
+
+def _comment_line(m, line):
+    return CommentLine(m.group('c_comment'), m.group('c_csep'), line)
+
+def _section_line(m, line):
+    name, csep, comment = m.group('s_name', 's_csep', 's_comment')
+    return SectionLine(name, comment, csep, m.start('s_csep'), line)
+
+def _option_line(m, line):
+    name, sep, value = m.group('o_name', 'o_sep', 'o_value')
+    return OptionLine._build(name, sep, value, m.start('o_value'), line)
+
+def _continuation_line(m, line):
+    return ContinuationLine(m.group('k_value'), m.start('k_value'), line)
+
+def _lazy_section_line(m, line):
+    return SectionLine.lazy(m.group('s_name'), line)
+
+def _lazy_option_line(m, line):
+    return OptionLine.lazy(m.group('o_name').rstrip(), line)
+
+_line_builders = {
+    'comment_line': _comment_line,
+    'section_line': _section_line,
+    'option_line': _option_line,
+    'continuation_line': _continuation_line,
+}
+
+_lazy_line_builders = dict(_line_builders,
+                           section_line=_lazy_section_line,
+                           option_line=_lazy_option_line)
+
+def parse_line(line, lazy=False):
+    """Classify a line, returning the matching LineType or None
+
+    Equivalent to trying EmptyLine, CommentLine, SectionLine,
+    OptionLine and ContinuationLine in turn, but needs only one
+    rstrip() and one regex match per line.  If lazy is true, section
+    and option lines only get their name until other fields are used.
+    """
+    stripped = line.rstrip()
+    if not stripped:
+        return EmptyLine(line)
+    m = _line_regex.match(stripped)
+    if m is None:
+        return None
+    if lazy:
+        return _lazy_line_builders[m.lastgroup](m, line)
+    return _line_builders[m.lastgroup](m, line)
+
+
 class LineContainer(object):
+    # set whenever lines are added or removed, and cleared by
+    # INIConfig.clean_format() once it has tidied the contents
+    dirty = True
+    # lines discard()ed but not yet taken out of the list, by id
+    _removed = None
+
     def __init__(self, d=None):
-        self.contents = []
+        self._contents = []
         self.orgvalue = None
         if d:
             if isinstance(d, list): self.extend(d)
             else: self.add(d)
 
+    # Removing lines one at a time from a long list would take time
+    # proportional to its length for each of them, so discard() only
+    # records them and they are all dropped the next time the list is
+    # looked at.
+    def get_contents(self):
+        if self._removed:
+            removed = self._removed
+            self._contents = [x for x in self._contents
+                              if id(x) not in removed]
+            self._removed = None
+        return self._contents
+
+    def set_contents(self, contents):
+        self._contents = contents
+        self._removed = None
+
+    contents = property(get_contents, set_contents)
+
     def add(self, x):
-        self.contents.append(x)
+        if self._removed and id(x) in self._removed:
+            # x is added again, at the end
+            self.get_contents()
+        self._contents.append(x)
+        self.dirty = True
+
+    def discard(self, x):
+        """Remove the line x, which must be in this container"""
+        if self._removed is None:
+            self._removed = {}
+        self._removed[id(x)] = x
+        self.dirty = True
+
+    def copy(self):
+        obj = LineContainer()
+        obj.contents = self.contents[:]
+        obj.orgvalue = self.orgvalue
+        obj.dirty = self.dirty
+        return obj
 
     def extend(self, x):
         for i in x: self.add(i)
@@ -230,8 +405,12 @@ class LineContainer(object):
     def get_name(self):
         return self.contents[0].name
 
+    # The first line is replaced by an updated copy rather than being
+    # changed, since a snapshot of the config may still refer to it.
     def set_name(self, data):
-        self.contents[0].name = data
+        line = self.contents[0].copy()
+        line.update(name=data)
+        self.contents[0] = line
 
     def get_value(self):
         if self.orgvalue is not None:
@@ -257,8 +436,9 @@ class LineContainer(object):
                 break
 
         # Rebuild contents list, preserving initial OptionLine
-        self.contents = self.contents[0:1]
-        self.contents[0].value = lines[0]
+        line = self.contents[0].copy()
+        line.update(value=lines[0])
+        self.contents = [line]
         del lines[0]
         for line in lines:
             if line.strip():
@@ -273,6 +453,28 @@ class LineContainer(object):
         s = [x.__str__() for x in self.contents]
         return '\n'.join(s)
 
+    def collect_lines(self, out, flush=None):
+        """Append the text of each line of str(self) to out
+
+        If flush is given, it is called with out after each nested
+        container once out holds 1024 lines or more, to write them and
+        take them out of it.
+        """
+        contents = self.contents
+        if not contents:
+            out.append('')
+        append = out.append
+        for x in contents:
+            if x.__class__ is LineContainer:
+                x.collect_lines(out, flush)
+                if flush is not None and len(out) >= 1024:
+                    flush(out)
+            elif x.line is not None:
+                # unchanged lines are copied as they were read
+                append(x.line)
+            else:
+                append(x.to_string())
+
     def finditer(self, key):
         for x in self.contents[::-1]:
             if hasattr(x, 'name') and x.name==key:
@@ -284,6 +486,88 @@ class LineContainer(object):
         raise KeyError(key)
 
 
+def _save_container(obj):
+    return (obj, obj.contents[:], obj.orgvalue, obj.dirty)
+
+
+def _restore_container(saved, copies):
+    # a new container with the saved state, since the old one may be
+    # shared with a copy of the config made after the state was saved
+    obj, contents, orgvalue, dirty = saved
+    new = LineContainer()
+    new.contents = [copies.get(id(x), x) for x in contents]
+    new.orgvalue = orgvalue
+    new.dirty = dirty
+    copies[id(obj)] = new
+    return new
+
+
+def _collapse_empty_lines(contents):
+    """Drop every EmptyLine that directly follows another, in one pass"""
+    ans = []
+    prev_empty = False
+    for x in contents:
+        is_empty = isinstance(x, EmptyLine)
+        if not (is_empty and prev_empty):
+            ans.append(x)
+        prev_empty = is_empty
+    if len(ans) != len(contents):
+        contents[:] = ans
+
+
+class NameIndex(object):
+    """Names in the order they were first added
+
+    Adding and removing a name take constant time, and
+    iterating takes time proportional to the number of names.
+    """
+    def __init__(self):
+        self._names = []
+        self._positions = {}
+        self._holes = 0
+
+    def __contains__(self, name):
+        return name in self._positions
+
+    def __len__(self):
+        return len(self._positions)
+
+    def __iter__(self):
+        # iterate over a copy, so that names can be added or removed
+        # while iterating
+        for name in self._names[:]:
+            if name is not None:
+                yield name
+
+    def add(self, name):
+        if name not in self._positions:
+            self._positions[name] = len(self._names)
+            self._names.append(name)
+
+    def remove(self, name):
+        pos = self._positions.pop(name, None)
+        if pos is None:
+            return
+        self._names[pos] = None
+        self._holes += 1
+        if self._holes > 16 and self._holes * 2 > len(self._names):
+            self._names = [x for x in self._names if x is not None]
+            self._positions = dict([(x, i) for i, x in
+                                    enumerate(self._names)])
+            self._holes = 0
+
+    def copy(self):
+        obj = NameIndex()
+        obj._names = self._names[:]
+        obj._positions = self._positions.copy()
+        obj._holes = self._holes
+        return obj
+
+
+# how many keys INIConfig._xkey() remembers
+_XFORM_MEMO_SIZE = 1024
+
+
 def _make_xform_property(myattrname, srcattrname=None):
     private_attrname = myattrname + 'value'
     private_srcname = myattrname + 'source'
@@ -310,43 +594,92 @@ def _make_xform_property(myattrname, srcattrname=None):
 class INISection(config.ConfigNamespace):
     _lines = None
     _options = None
+    _optionrefs = None
+    _names = None
     _defaults = None
     _optionxformvalue = None
     _optionxformsource = None
-    _compat_skip_empty_lines = set()
+    _config = None
+    # set while the LineContainers of this section may be shared with
+    # a copy of the config; they are copied before being changed
+    _shared = False
+    # options whose value came from lines with empty lines among them,
+    # which ConfigParser would have skipped
+    _compat_skip_empty_lines = None
     def __init__(self, lineobj, defaults = None,
-                       optionxformvalue=None, optionxformsource=None):
+                       optionxformvalue=None, optionxformsource=None,
+                       config=None):
         self._lines = [lineobj]
         self._defaults = defaults
+        self._config = config
         self._optionxformvalue = optionxformvalue
         self._optionxformsource = optionxformsource
         self._options = {}
+        # every (block, LineContainer) holding each option, so that
+        # deleting it doesn't have to search the whole section
+        self._optionrefs = {}
+        self._names = NameIndex()
+        self._compat_skip_empty_lines = set()
 
     _optionxform = _make_xform_property('_optionxform')
 
-    def _compat_get(self, key):
-        # identical to __getitem__ except that _compat_XXX
+    def _xkey(self, key):
+        if self._config is not None and \
+                self._optionxformsource is self._config:
+            return self._config._xkey(key)
+        xform = self._optionxform
+        if xform:
+            return xform(key)
+        return key
+
+    def _add_option(self, xkey, block, obj):
+        self._options[xkey] = obj
+        self._names.add(xkey)
+        refs = self._optionrefs.get(xkey)
+        if refs is None:
+            self._optionrefs[xkey] = [(block, obj)]
+        else:
+            refs.append((block, obj))
+
+    def _compat_get(self, key, default=None):
+        # identical to _get except that _compat_XXX
         # is checked for backward-compatible handling
         if key == '__name__':
             return self._lines[-1].name
-        if self._optionxform: key = self._optionxform(key)
-        try:
-            value = self._options[key].value
+        key = self._xkey(key)
+        obj = self._options.get(key)
+        if obj is not None:
             del_empty = key in self._compat_skip_empty_lines
-        except KeyError:
-            if self._defaults and key in self._defaults._options:
-                value = self._defaults._options[key].value
-                del_empty = key in self._defaults._compat_skip_empty_lines
-            else:
-                raise
+        elif self._defaults:
+            obj = self._defaults._options.get(key)
+            if obj is None:
+                return default
+            del_empty = key in self._defaults._compat_skip_empty_lines
+        else:
+            return default
+        value = obj.value
         if del_empty:
             value = re.sub('\n+', '\n', value)
         return value
 
+    def _compat_values(self):
+        # every option as _compat_get would return it, in one pass
+        if self._defaults:
+            d = self._defaults._compat_values()
+        else:
+            d = {}
+        skip = self._compat_skip_empty_lines
+        for key, obj in self._options.iteritems():
+            value = obj.value
+            if key in skip:
+                value = re.sub('\n+', '\n', value)
+            d[key] = value
+        return d
+
     def __getitem__(self, key):
         if key == '__name__':
             return self._lines[-1].name
-        if self._optionxform: key = self._optionxform(key)
+        key = self._xkey(key)
         try:
             return self._options[key].value
         except KeyError:
@@ -355,57 +688,136 @@ class INISection(config.ConfigNamespace):
             else:
                 raise
 
+    def _get(self, key, default=None):
+        if key == '__name__':
+            return self._lines[-1].name
+        key = self._xkey(key)
+        obj = self._options.get(key)
+        if obj is None and self._defaults:
+            obj = self._defaults._options.get(key)
+        if obj is None:
+            return default
+        return obj.value
+
     def __setitem__(self, key, value):
-        if self._optionxform: xkey = self._optionxform(key)
-        else: xkey = key
+        if self._shared:
+            self._unshare()
+        xkey = self._xkey(key)
         if xkey in self._compat_skip_empty_lines:
             self._compat_skip_empty_lines.remove(xkey)
         if xkey not in self._options:
             # create a dummy object - value may have multiple lines
             obj = LineContainer(OptionLine(key, ''))
             self._lines[-1].add(obj)
-            self._options[xkey] = obj
+            self._add_option(xkey, self._lines[-1], obj)
         # the set_value() function in LineContainer
         # automatically handles multi-line values
         self._options[xkey].value = value
+        if self._config is not None:
+            self._config._changes += 1
 
     def __delitem__(self, key):
-        if self._optionxform: key = self._optionxform(key)
+        if not self._remove(key):
+            raise KeyError(key)
+
+    def _remove(self, key):
+        # __delitem__ that returns whether key was there
+        key = self._xkey(key)
+        if key not in self._options:
+            return False
+        if self._shared:
+            self._unshare()
         if key in self._compat_skip_empty_lines:
             self._compat_skip_empty_lines.remove(key)
-        for l in self._lines:
-            remaining = []
-            for o in l.contents:
-                if isinstance(o, LineContainer):
-                    n = o.name
-                    if self._optionxform: n = self._optionxform(n)
-                    if key != n: remaining.append(o)
-                else:
-                    remaining.append(o)
-            l.contents = remaining
+        for block, obj in self._optionrefs.pop(key, ()):
+            block.discard(obj)
         del self._options[key]
+        self._names.remove(key)
+        if self._config is not None:
+            self._config._changes += 1
+        return True
 
     def __iter__(self):
-        d = set()
-        for l in self._lines:
-            for x in l.contents:
-                if isinstance(x, LineContainer):
-                    if self._optionxform:
-                        ans = self._optionxform(x.name)
-                    else:
-                        ans = x.name
-                    if ans not in d:
-                        yield ans
-                        d.add(ans)
+        for x in self._names:
+            yield x
         if self._defaults:
             for x in self._defaults:
-                if x not in d:
+                if x not in self._names:
                     yield x
-                    d.add(x)
 
     def _new_namespace(self, name):
         raise Exception('No sub-sections allowed', name)
 
+    def _snapshot(self):
+        refs = {}
+        for key, value in self._optionrefs.iteritems():
+            refs[key] = value[:]
+        return (self._lines[:], self._options.copy(), refs,
+                self._names.copy(), self._compat_skip_empty_lines.copy())
+
+    def _restore(self, state, copies):
+        # copies maps the id of every saved LineContainer to the new
+        # one that replaces it
+        lines, options, refs, names, skip = state
+        self._lines = [copies[id(x)] for x in lines]
+        self._options = {}
+        for key, obj in options.iteritems():
+            self._options[key] = copies[id(obj)]
+        self._optionrefs = {}
+        for key, value in refs.iteritems():
+            self._optionrefs[key] = [(copies[id(block)], copies[id(obj)])
+                                     for block, obj in value]
+        self._names = names.copy()
+        self._compat_skip_empty_lines = skip.copy()
+        self._shared = False
+
+    def _copy(self, config, defaults):
+        # a section that shares everything with this one until either
+        # of them is changed
+        obj = self.__class__.__new__(self.__class__)
+        obj._lines = self._lines
+        obj._options = self._options
+        obj._optionrefs = self._optionrefs
+        obj._names = self._names
+        obj._compat_skip_empty_lines = self._compat_skip_empty_lines
+        obj._defaults = defaults
+        obj._config = config
+        obj._optionxformvalue = self._optionxformvalue
+        if self._optionxformsource is self._config:
+            obj._optionxformsource = config
+        else:
+            obj._optionxformsource = self._optionxformsource
+        obj._shared = self._shared = True
+        return obj
+
+    def _unshare(self):
+        # give this section its own copy of every LineContainer in it
+        copies = {}
+        lines = []
+        for block in self._lines:
+            new = block.copy()
+            for i, x in enumerate(new.contents):
+                if isinstance(x, LineContainer):
+                    new.contents[i] = copies[id(x)] = x.copy()
+            copies[id(block)] = new
+            lines.append(new)
+        options = {}
+        for key, obj in self._options.iteritems():
+            options[key] = copies[id(obj)]
+        refs = {}
+        for key, value in self._optionrefs.iteritems():
+            refs[key] = [(copies[id(block)], copies[id(obj)])
+                         for block, obj in value]
+        self._lines = lines
+        self._options = options
+        self._optionrefs = refs
+        self._names = self._names.copy()
+        self._compat_skip_empty_lines = self._compat_skip_empty_lines.copy()
+        if self._config is not None:
+            data = self._config._data
+            data.contents = [copies.get(id(x), x) for x in data.contents]
+        self._shared = False
+
 
 def make_comment(line):
     return CommentLine(line.rstrip('\n'))
@@ -431,6 +843,26 @@ def readline_iterator(f):
         yield line
 
 
+def read_lines(f):
+    """split a file into lines using a single call to its read method
+
+    The lines are the same as those produced by readline_iterator,
+    including the empty string that follows a final newline.
+    """
+    return split_lines(f.read())
+
+
+def split_lines(data):
+    """split the contents of a file as read_lines does"""
+    if not data:
+        return []
+    lines = data.split('\n')
+    last = lines.pop()
+    lines = [l + '\n' for l in lines]
+    lines.append(last)
+    return lines
+
+
 def lower(x):
     return x.lower()
 
@@ -438,25 +870,38 @@ def lower(x):
 class INIConfig(config.ConfigNamespace):
     _data = None
     _sections = None
+    _names = None
     _defaults = None
     _optionxformvalue = None
     _optionxformsource = None
     _sectionxformvalue = None
     _sectionxformsource = None
     _parse_exc = None
+    _lazy = False
     _bom = False
+    # incremented by every change to the sections or options, so that
+    # anything derived from them can tell when it is out of date
+    _changes = 0
+    # optionxform results for recently used keys, valid while the
+    # optionxform function is _xform_func
+    _xform_memo = None
+    _xform_func = None
     def __init__(self, fp=None, defaults=None, parse_exc=True,
                  optionxformvalue=lower, optionxformsource=None,
-                 sectionxformvalue=None, sectionxformsource=None):
+                 sectionxformvalue=None, sectionxformsource=None,
+                 lazy=False):
         self._data = LineContainer()
         self._parse_exc = parse_exc
+        self._lazy = lazy
         self._optionxformvalue = optionxformvalue
         self._optionxformsource = optionxformsource
         self._sectionxformvalue = sectionxformvalue
         self._sectionxformsource = sectionxformsource
         self._sections = {}
+        self._names = NameIndex()
         if defaults is None: defaults = {}
-        self._defaults = INISection(LineContainer(), optionxformsource=self)
+        self._defaults = INISection(LineContainer(), optionxformsource=self,
+                                    config=self)
         for name, value in defaults.iteritems():
             self._defaults[name] = value
         if fp is not None:
@@ -468,45 +913,150 @@ class INIConfig(config.ConfigNamespace):
     def __getitem__(self, key):
         if key == DEFAULTSECT:
             return self._defaults
-        if self._sectionxform: key = self._sectionxform(key)
+        xform = self._sectionxform
+        if xform: key = xform(key)
         return self._sections[key]
 
+    def _get(self, key, default=None):
+        if key == DEFAULTSECT:
+            return self._defaults
+        xform = self._sectionxform
+        if xform: key = xform(key)
+        return self._sections.get(key, default)
+
+    def _xkey(self, key):
+        # optionxform(key), remembered for the most recent keys
+        xform = self._optionxform
+        if not xform:
+            return key
+        if xform != self._xform_func:
+            self._xform_func = xform
+            self._xform_memo = {}
+        memo = self._xform_memo
+        xkey = memo.get(key)
+        if xkey is None:
+            if len(memo) >= _XFORM_MEMO_SIZE:
+                memo.clear()
+            xkey = memo[key] = xform(key)
+        return xkey
+
     def __setitem__(self, key, value):
         raise Exception('Values must be inside sections', key, value)
 
     def __delitem__(self, key):
         if self._sectionxform: key = self._sectionxform(key)
         for line in self._sections[key]._lines:
-            self._data.contents.remove(line)
+            self._data.discard(line)
         del self._sections[key]
+        self._names.remove(key)
+        self._changes += 1
 
     def __iter__(self):
-        d = set()
-        d.add(DEFAULTSECT)
-        for x in self._data.contents:
-            if isinstance(x, LineContainer):
-                if x.name not in d:
-                    yield x.name
-                    d.add(x.name)
-                    
-    def clean_format(self):
+        for key in self._names:
+            # the name as written in the first [section] header
+            yield self._sections[key]._lines[0].name
+
+    def _snapshot(self):
+        """Return the state that _restore() needs to undo later changes
+
+        Only changes made through INIConfig, INISection and
+        LineContainer methods can be undone; lines are shared with
+        the snapshot, so they must not be changed directly.
+        """
+        # options come before the blocks holding them, so that
+        # _restore() has made their new containers when it needs them
+        containers = []
+        blocks = [self._defaults._lines[0]]
+        blocks.extend([x for x in self._data.contents
+                       if isinstance(x, LineContainer)])
+        for block in blocks:
+            for x in block.contents:
+                if isinstance(x, LineContainer):
+                    containers.append(_save_container(x))
+            containers.append(_save_container(block))
+        sections = [(ns, ns._snapshot()) for ns in self._sections.values()]
+        sections.append((self._defaults, self._defaults._snapshot()))
+        return (_save_container(self._data), containers,
+                self._sections.copy(), self._names.copy(), sections,
+                self._bom)
+
+    def _restore(self, state):
+        """Undo every change made since _snapshot() returned state
+
+        The lines are put back in new LineContainers, leaving the
+        current ones to any copy of the config that still uses them.
+        """
+        data, containers, sections, names, section_states, bom = state
+        copies = {}
+        for saved in containers:
+            _restore_container(saved, copies)
+        obj, contents, orgvalue, dirty = data
+        self._data.contents = [copies.get(id(x), x) for x in contents]
+        self._data.orgvalue = orgvalue
+        self._data.dirty = dirty
+        self._sections = sections.copy()
+        self._names = names.copy()
+        for ns, ns_state in section_states:
+            ns._restore(ns_state, copies)
+        self._bom = bom
+        self._changes += 1
+
+    def _copy(self):
+        """Return a copy of the config that can be changed independently
+
+        The copies share their sections and lines until one of them
+        changes a section, which then gets its own copy of that
+        section only.  Making a copy takes time proportional to the
+        number of sections, not to the size of the file.
+        """
+        obj = self.__class__.__new__(self.__class__)
+        obj._parse_exc = self._parse_exc
+        obj._lazy = self._lazy
+        obj._bom = self._bom
+        obj._optionxformvalue = self._optionxformvalue
+        obj._optionxformsource = self._optionxformsource
+        obj._sectionxformvalue = self._sectionxformvalue
+        obj._sectionxformsource = self._sectionxformsource
+        obj._data = LineContainer()
+        obj._data.contents = self._data.contents[:]
+        obj._data.dirty = self._data.dirty
+        obj._names = self._names.copy()
+        obj._defaults = self._defaults._copy(obj, None)
+        obj._sections = {}
+        for key, ns in self._sections.iteritems():
+            obj._sections[key] = ns._copy(obj, obj._defaults)
+        return obj
+
+    def clean_format(self, trailing=True):
         ''' 
         this functions makes the configuration look
         clean and handwritten - two consecutive EmptyLines are removed,
-        and one is guaranteed to be at the end of the file
+        both between and within sections, and one is guaranteed to be
+        at the end of the file (unless trailing is false, for text that
+        is not the end of a file).  Only the parts of the file changed
+        since the previous call are looked at again.
         '''
-        cont = self._data.contents
-        if (len(cont) > 1):
-            for i in range(1, len(cont)):
-                if i > len(cont)-1:
-                    break
-                while isinstance(cont[i-1], EmptyLine) and isinstance(cont[i], EmptyLine):
-                    cont.remove(cont[i])
-                    if i > len(cont)-1:
+        # sections shared with a copy of the config are copied before
+        # their blocks are tidied
+        for ns in [self._defaults] + self._sections.values():
+            if ns._shared:
+                for block in ns._lines:
+                    if block.dirty:
+                        ns._unshare()
                         break
-        if cont and not isinstance(cont[len(cont) - 1], EmptyLine):
-            self._data.add(EmptyLine())
-    
+        data = self._data
+        if data.dirty:
+            _collapse_empty_lines(data.contents)
+            data.dirty = False
+        # Only sections changed since the last call need another pass
+        for block in data.contents:
+            if isinstance(block, LineContainer) and block.dirty:
+                _collapse_empty_lines(block.contents)
+                block.dirty = False
+        cont = data.contents
+        if trailing and cont and not isinstance(cont[-1], EmptyLine):
+            data.add(EmptyLine())
+            data.dirty = False
 
     def _new_namespace(self, name):
         if self._data.contents:
@@ -517,11 +1067,15 @@ class INIConfig(config.ConfigNamespace):
         if self._sectionxform: name = self._sectionxform(name)
         if name in self._sections:
             ns = self._sections[name]
+            if ns._shared:
+                ns._unshare()
             ns._lines.append(obj)
         else:
             ns = INISection(obj, defaults=self._defaults,
-                            optionxformsource=self)
+                            optionxformsource=self, config=self)
             self._sections[name] = ns
+            self._names.add(name)
+        self._changes += 1
         return ns
 
     def __str__(self):
@@ -533,42 +1087,68 @@ class INIConfig(config.ConfigNamespace):
 
     __unicode__ = __str__
 
-    _line_types = [EmptyLine, CommentLine,
-                   SectionLine, OptionLine,
-                   ContinuationLine]
+    def _write(self, fp):
+        """Write the same text as __str__ to fp, a chunk at a time"""
+        if self._bom:
+            fp.write(u'\ufeff')
+        def flush(lines):
+            # the last line is kept back, as no newline follows it if
+            # it ends the file
+            fp.write('\n'.join(lines[:-1]) + '\n')
+            del lines[:-1]
+        chunk = []
+        for x in self._data.contents:
+            if isinstance(x, LineContainer):
+                x.collect_lines(chunk, flush)
+            else:
+                chunk.append(x.__str__())
+            if len(chunk) >= 1024:
+                flush(chunk)
+        if chunk:
+            fp.write('\n'.join(chunk))
 
     def _parse(self, line):
-        for linetype in self._line_types:
-            lineobj = linetype.parse(line)
-            if lineobj:
-                return lineobj
-        else:
-            # can't parse line
-            return None
+        return parse_line(line, self._lazy)
 
     def _readfp(self, fp):
+        try:
+            fname = fp.name
+        except AttributeError:
+            fname = '<???>'
+        if hasattr(fp, 'read'):
+            lines = read_lines(fp)
+        else:
+            lines = list(readline_iterator(fp))
+        self._load(fname, lines, self._parse_lines(lines))
+
+    def _parse_lines(self, lines):
+        """Return the LineType of each line, or None if it can't be parsed"""
+        # Check for BOM on first line
+        if lines and isinstance(lines[0], unicode):
+            if lines[0][0] == u'\ufeff':
+                lines[0] = lines[0][1:]
+                self._bom = True
+        return map(self._parse, lines)
+
+    def _load(self, fname, lines, lineobjs, firstline=1):
+        """Build the section and option structure from parsed lines
+
+        Errors are reported with line numbers counted from firstline.
+        """
         cur_section = None
         cur_option = None
         cur_section_name = None
         cur_option_name = None
         pending_lines = []
         pending_empty_lines = False
-        try:
-            fname = fp.name
-        except AttributeError:
-            fname = '<???>'
-        linecount = 0
+        linecount = firstline - 1
         exc = None
         line = None
+        self._changes += 1
+        optionxform = self._optionxform
+        sectionxform = self._sectionxform
 
-        for line in readline_iterator(fp):
-            # Check for BOM on first line
-            if linecount == 0 and isinstance(line, unicode):
-                if line[0] == u'\ufeff':
-                    line = line[1:]
-                    self._bom = True
-
-            lineobj = self._parse(line)
+        for line, lineobj in izip(lines, lineobjs):
             linecount += 1
 
             if not cur_section and not isinstance(lineobj,
@@ -607,15 +1187,15 @@ class INIConfig(config.ConfigNamespace):
                     pending_empty_lines = False
                 cur_option = LineContainer(lineobj)
                 cur_section.add(cur_option)
-                if self._optionxform:
-                    cur_option_name = self._optionxform(cur_option.name)
+                if optionxform:
+                    cur_option_name = optionxform(cur_option.name)
                 else:
                     cur_option_name = cur_option.name
                 if cur_section_name == DEFAULTSECT:
                     optobj = self._defaults
                 else:
                     optobj = self._sections[cur_section_name]
-                optobj._options[cur_option_name] = cur_option
+                optobj._add_option(cur_option_name, cur_section, cur_option)
 
             if isinstance(lineobj, SectionLine):
                 self._data.extend(pending_lines)
@@ -626,19 +1206,26 @@ class INIConfig(config.ConfigNamespace):
                 cur_option = None
                 cur_option_name = None
                 if cur_section.name == DEFAULTSECT:
+                    if self._defaults._shared:
+                        self._defaults._unshare()
                     self._defaults._lines.append(cur_section)
                     cur_section_name = DEFAULTSECT
                 else:
-                    if self._sectionxform:
-                        cur_section_name = self._sectionxform(cur_section.name)
+                    if sectionxform:
+                        cur_section_name = sectionxform(cur_section.name)
                     else:
                         cur_section_name = cur_section.name
                     if cur_section_name not in self._sections:
                         self._sections[cur_section_name] = \
                                 INISection(cur_section, defaults=self._defaults,
-                                           optionxformsource=self)
+                                           optionxformsource=self,
+                                           config=self)
+                        self._names.add(cur_section_name)
                     else:
-                        self._sections[cur_section_name]._lines.append(cur_section)
+                        ns = self._sections[cur_section_name]
+                        if ns._shared:
+                            ns._unshare()
+                        ns._lines.append(cur_section)
 
             if isinstance(lineobj, (CommentLine, EmptyLine)):
                 pending_lines.append(lineobj)
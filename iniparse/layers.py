@@ -0,0 +1,234 @@
+"""Read-only view of Mercurial configuration files layered on each other
+
+A LayeredConfig reads a list of files in order, with each file
+overriding the options set by the ones before it, the way Mercurial
+reads its configuration files.  It keeps an index of the effective
+value of every option together with the file and line that set it,
+so both are found with a dictionary lookup:
+
+    >>> import tempfile
+    >>> system = tempfile.mktemp()
+    >>> open(system, 'w').write('[ui]\\nverbose = 1\\nusername = root\\n')
+    >>> user = tempfile.mktemp()
+    >>> open(user, 'w').write('[ui]\\n# me\\nusername = jdoe\\n')
+    >>> layers = LayeredConfig([system, user])
+    >>> layers.get('ui', 'username')
+    'jdoe'
+    >>> layers.origin('ui', 'username') == (user, 3)
+    True
+    >>> layers.origin('ui', 'verbose') == (system, 2)
+    True
+
+When one file changes, only that file is read again, and only the
+options it sets or used to set are looked up again in the other files:
+
+    >>> open(user, 'w').write('[ui]\\nverbose = 0\\n')
+    >>> layers.refresh() == [user]
+    True
+    >>> layers.items('ui')
+    [('username', 'root'), ('verbose', '0')]
+
+Files are read with Mercurial's rules rather than INIConfig's.  Values
+are kept as written, ';' and '#' included, section and option names
+are case-sensitive, and %include and %unset are followed:
+
+    >>> extra = tempfile.mktemp()
+    >>> open(extra, 'w').write('[paths]\\ndefault = http://x/y ;z\\n')
+    >>> open(user, 'w').write('%%include %s\\n[ui]\\n%%unset verbose\\n'
+    ...                       % extra)
+    >>> layers.refresh() == [user]
+    True
+    >>> layers.get('paths', 'default')
+    'http://x/y ;z'
+    >>> layers.origin('paths', 'default') == (extra, 2)
+    True
+    >>> layers.items('ui')
+    [('username', 'root')]
+
+A file counts as changed when a file it includes does:
+
+    >>> open(extra, 'w').write('[paths]\\n')
+    >>> layers.refresh() == [user]
+    True
+    >>> print layers.get('paths', 'default')
+    None
+
+[DEFAULT] is an ordinary section, as it is to Mercurial, and lines
+that Mercurial would reject are skipped.
+"""
+
+import os
+import re
+
+# the line grammar of Mercurial's configuration parser
+_section_re = re.compile(r'\[([^\[]+)\]')
+_item_re = re.compile(r'([^=\s][^=]*?)\s*=\s*(.*\S|)')
+_cont_re = re.compile(r'\s+(\S|\S.*\S)\s*$')
+_empty_re = re.compile(r'(;|#|\s*$)')
+_comment_re = re.compile(r'(;|#)')
+_unset_re = re.compile(r'%unset\s+(\S+)')
+_include_re = re.compile(r'%include\s+(\S|\S.*\S)\s*$')
+
+
+class LayeredConfig(object):
+    def __init__(self, paths=()):
+        # [path, [(path, (mtime, size) or None)] for it and the files it
+        # includes, {(section, option): (value, path, lineno) or None}]
+        # for every file, lowest first; None marks an option %unset
+        self._layers = []
+        # section -> option -> (value, path, lineno)
+        self._index = {}
+        for path in paths:
+            self.add_layer(path)
+
+    def paths(self):
+        """Return the paths of the files, lowest first"""
+        return [layer[0] for layer in self._layers]
+
+    def add_layer(self, path):
+        """Read path as a new file on top of the existing ones
+
+        A file that can't be read counts as an empty one.
+        """
+        files, entries = self._read(path)
+        self._layers.append([path, files, entries])
+        for key in entries:
+            self._reindex(key)
+
+    def update(self, path):
+        """Read path again after it or a file it includes has changed"""
+        for layer in self._layers:
+            if layer[0] == path:
+                break
+        else:
+            raise ValueError('No such layer', path)
+        files, entries = self._read(path)
+        changed = set(layer[2])
+        changed.update(entries)
+        layer[1] = files
+        layer[2] = entries
+        for key in changed:
+            self._reindex(key)
+
+    def refresh(self):
+        """Read again the files whose size or modification time changed,
+        or that include such a file
+
+        Returns the paths of the files that were read.
+        """
+        ans = []
+        for path, files, entries in self._layers:
+            for name, stat in files:
+                if self._stat(name) != stat:
+                    self.update(path)
+                    ans.append(path)
+                    break
+        return ans
+
+    def get(self, section, option, default=None):
+        """Return the effective value of option, or default if unset"""
+        entry = self._index.get(section, {}).get(option)
+        if entry is None:
+            return default
+        return entry[0]
+
+    def origin(self, section, option):
+        """Return (path, lineno) of the line that set option, or None"""
+        entry = self._index.get(section, {}).get(option)
+        if entry is None:
+            return None
+        return entry[1:]
+
+    def sections(self):
+        """Return the sections that set any options, in sorted order"""
+        ans = self._index.keys()
+        ans.sort()
+        return ans
+
+    def items(self, section):
+        """Return (option, value) for each option of section, sorted"""
+        ans = [(option, entry[0])
+               for option, entry in self._index.get(section, {}).iteritems()]
+        ans.sort()
+        return ans
+
+    def _reindex(self, key):
+        # find the effective value of key after a layer changed
+        section, option = key
+        for path, files, entries in reversed(self._layers):
+            if key in entries:
+                entry = entries[key]
+                if entry is not None:
+                    self._index.setdefault(section, {})[option] = entry
+                    return
+                break
+        options = self._index.get(section)
+        if options is not None:
+            options.pop(option, None)
+            if not options:
+                del self._index[section]
+
+    def _stat(self, path):
+        try:
+            st = os.stat(path)
+        except OSError:
+            return None
+        return (st.st_mtime, st.st_size)
+
+    def _read(self, path):
+        files = []
+        entries = {}
+        self._parse(path, files, entries, ())
+        return files, entries
+
+    def _parse(self, path, files, entries, including):
+        # follows config.parse() in Mercurial, with the files that
+        # include this one in including, so that cycles are cut
+        files.append((path, self._stat(path)))
+        try:
+            fp = open(path)
+        except IOError:
+            return
+        try:
+            data = fp.read()
+        finally:
+            fp.close()
+        including += (path,)
+        section = ''
+        item = None
+        for lineno, line in enumerate(data.splitlines(True)):
+            lineno += 1
+            if lineno == 1 and line.startswith('\xef\xbb\xbf'):
+                line = line[3:]
+            if item is not None:
+                if _comment_re.match(line):
+                    continue
+                m = _cont_re.match(line)
+                if m:
+                    value, src, first = entries[(section, item)]
+                    entries[(section, item)] = \
+                            (value + '\n' + m.group(1), src, first)
+                    continue
+                item = None
+            m = _include_re.match(line)
+            if m:
+                inc = os.path.expanduser(os.path.expandvars(m.group(1)))
+                inc = os.path.normpath(os.path.join(os.path.dirname(path),
+                                                    inc))
+                if inc not in including:
+                    self._parse(inc, files, entries, including)
+                continue
+            if _empty_re.match(line):
+                continue
+            m = _section_re.match(line)
+            if m:
+                section = m.group(1)
+                continue
+            m = _item_re.match(line)
+            if m:
+                item = m.group(1)
+                entries[(section, item)] = (m.group(2), path, lineno)
+                continue
+            m = _unset_re.match(line)
+            if m:
+                entries[(section, m.group(1))] = None